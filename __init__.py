@@ -3,10 +3,14 @@ from .src import nodes
 NODE_CLASS_MAPPINGS = {
     "DanbotLoadModel": nodes.LoadModelNode,
     "DanbotGeneratorNode": nodes.GeneratorNode,
+    "DanbotBatchGeneratorNode": nodes.BatchGeneratorNode,
+    "DanbotSeedSweepGeneratorNode": nodes.SeedSweepGeneratorNode,
     "DanbotGenerationConfig": nodes.GenerationConfigNode,
     "DanbotTranslationExtractorNode": nodes.TranslationExtractorNode,
     "DanbotEtensionExtractorNode": nodes.ExtensionExtractorNode,
     "DanbotLoadBanTagsNode": nodes.LoadBanTagsNode,
+    "DanbotLoadBanMaskNode": nodes.LoadBanMaskNode,
+    "DanbotBanMaskSetOperationNode": nodes.BanMaskSetOperationNode,
     #
     "DanbotV2408AutoAspectRatioTag": nodes.V2408AutoAspectRatioTagNode,
     "DanbotV2408PipelineNode": nodes.V2408PipelineNode,
@@ -22,10 +26,14 @@ NODE_CLASS_MAPPINGS = {
 NODE_DISPLAY_NAME_MAPPINGS = {
     "DanbotLoadModel": "Danbot Load Model",
     "DanbotGeneratorNode": "Danbot Generator",
+    "DanbotBatchGeneratorNode": "Danbot Batch Generator",
+    "DanbotSeedSweepGeneratorNode": "Danbot Seed Sweep Generator",
     "DanbotGenerationConfig": "Danbot Generation Config",
     "DanbotTranslationExtractorNode": "Danbot Translation Extractor",
     "DanbotEtensionExtractorNode": "Danbot Extension Extractor",
     "DanbotLoadBanTagsNode": "Danbot Load Ban Tags",
+    "DanbotLoadBanMaskNode": "Danbot Load Ban Mask",
+    "DanbotBanMaskSetOperationNode": "Danbot Ban Mask Set Operation",
     #
     "DanbotV2408AutoAspectRatioTag": "Danbot V2408 Auto Aspect Ratio Tag",
     "DanbotV2408PipelineNode": "Danbot V2408 Pipeline",
@@ -0,0 +1,589 @@
+"""
+Benchmark of the generation hot path.
+
+Usage (from this repository, ComfyUI is not required):
+    # CPU-only smoke run with a tiny randomly initialized model
+    python -m src.benchmark --tiny --precisions fp32 --output baseline.json
+    # compare against the saved baseline
+    python -m src.benchmark --tiny --precisions fp32 --baseline baseline.json
+    # compare the outputs of other precisions with bf16 on the prompt corpus
+    python -m src.benchmark --validate --precisions fp32 fp16 int8
+"""
+
+from dataclasses import dataclass, asdict, field
+from pathlib import Path
+from typing import Any, Callable
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+
+import torch
+from transformers import (
+    AutoConfig,
+    AutoModelForPreTraining,
+    AutoProcessor,
+    GenerationConfig,
+    PretrainedConfig,
+)
+from transformers.generation.streamers import BaseStreamer
+
+from .config import ModelConfig, load_models_configs
+from .models import PRECISION_TYPES, ModelWrapper, v2408
+from .models.metadata import split_tokens
+from .tags import BAN_TEMPLATE_DIR, load_tags, normalize_tag_text
+
+SELF_PATH_DIR = Path(__file__).parent
+TINY_MODEL_DIR = SELF_PATH_DIR / ".." / "benchmarks" / "tiny"
+
+# fixed prompt corpus, so that the results are comparable between runs
+BENCHMARK_PROMPTS = [
+    "A girl with cat ears and long black hair sitting on a sofa, looking at the viewer.",
+    "Pixel art of a chibi girl in a cardboard box, wearing a hoodie.",
+    "Two girls standing on a street in Tokyo at night, smiling.",
+    "A knight in silver armor holding a sword in front of a burning castle.",
+    "A boy with short brown hair reading a book in a library, sunlight from the window.",
+    "An old man fishing on a small boat on a misty lake at dawn.",
+    "A maid serving tea in a garden with roses, wide shot.",
+    "A robot and a girl walking hand in hand through a ruined city.",
+    "猫耳で黒髪ロング、制服を着ており、目は黄色の少女。ソファーに座っている。",
+    "ピクセルアート。猫耳の女の子がダンボール箱に入っている。",
+    "夕焼けの海辺で白いワンピースを着た少女が振り返っている。",
+    "雨の日に傘をさして駅のホームに立つ男の子。",
+    "桜の木の下でお弁当を食べている三人の女子高生。",
+    "魔法使いの少女が杖を掲げて空に魔法陣を描いている。",
+    "雪の積もった森の中で眠る白い狼。",
+    "メイド服を着た銀髪の少女がケーキを運んでいる。",
+]
+
+# reference precision of --validate
+VALIDATION_BASELINE_PRECISION = "bf16"
+
+# parameters of the tiny model. Only the attributes present in the config are replaced.
+TINY_CONFIG_OVERRIDES = {
+    "num_hidden_layers": 2,
+    "num_layers": 2,
+    "num_decoder_layers": 2,
+    "hidden_size": 64,
+    "d_model": 64,
+    "intermediate_size": 128,
+    "d_ff": 128,
+    "num_attention_heads": 2,
+    "num_key_value_heads": 1,
+    "head_dim": 32,
+}
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    params: dict[str, Any]
+
+    p50_ms: float
+    p95_ms: float
+    mean_ms: float
+    tokens_per_second: float | None
+    # peak RSS of the process until the end of this benchmark
+    peak_rss_mb: float
+
+    comparison: dict[str, float] = field(default_factory=dict)
+
+    @property
+    def key(self) -> str:
+        return json.dumps([self.name, self.params], sort_keys=True)
+
+
+class TokenCounter(BaseStreamer):
+    """
+    Counts the generated tokens except for the paddings of finished rows
+    """
+
+    def __init__(self, pad_token_id: int | None):
+        self.pad_token_id = pad_token_id
+        self.num_tokens = 0
+        self._is_prompt = True
+
+    def put(self, value: torch.Tensor):
+        # the first call is the prompt
+        if self._is_prompt:
+            self._is_prompt = False
+            return
+        if self.pad_token_id is not None:
+            value = value[value != self.pad_token_id]
+        self.num_tokens += value.numel()
+
+    def end(self):
+        self._is_prompt = True
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:  # Windows
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset / 2**20
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def measure(
+    name: str,
+    params: dict[str, Any],
+    fn: Callable[[], int | None],
+    repeat: int,
+    warmup: int,
+) -> BenchmarkResult:
+    """
+    Run `fn` and collect the latencies. `fn` returns the number of generated tokens if any.
+    """
+    for _ in range(warmup):
+        fn()
+
+    latencies, num_tokens = [], 0
+    for _ in range(repeat):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        tokens = fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        latencies.append(time.perf_counter() - start)
+        num_tokens += tokens or 0
+
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    result = BenchmarkResult(
+        name=name,
+        params=params,
+        p50_ms=statistics.median(latencies_ms),
+        p95_ms=latencies_ms[round(0.95 * (len(latencies_ms) - 1))],
+        mean_ms=statistics.fmean(latencies_ms),
+        tokens_per_second=(num_tokens / sum(latencies) if num_tokens > 0 else None),
+        peak_rss_mb=peak_rss_mb(),
+    )
+    logging.info(
+        f"{name} {params}: p50={result.p50_ms:.2f}ms p95={result.p95_ms:.2f}ms "
+        f"tokens/s={result.tokens_per_second}"
+    )
+    return result
+
+
+def shrink_config(config: PretrainedConfig):
+    for name, value in TINY_CONFIG_OVERRIDES.items():
+        if getattr(config, name, None) is not None:
+            setattr(config, name, value)
+
+    # encoder and decoder configs
+    for value in vars(config).values():
+        if isinstance(value, PretrainedConfig):
+            shrink_config(value)
+
+
+def prepare_tiny_model(config: ModelConfig) -> ModelConfig:
+    """
+    Save a randomly initialized copy of the model with tiny layers, keeping the tokenizers.
+    Only the configs and tokenizers are downloaded.
+    """
+    model_name_or_path = config.data["model_name_or_path"]
+    revision = config.data.get("revision")
+    output_dir = TINY_MODEL_DIR / model_name_or_path.replace("/", "--")
+
+    if not (output_dir / "config.json").exists():
+        logging.info(f"Creating tiny model of {model_name_or_path} in {output_dir}")
+        model_config = AutoConfig.from_pretrained(
+            model_name_or_path, revision=revision, trust_remote_code=True
+        )
+        shrink_config(model_config)
+        torch.manual_seed(0)
+        model = AutoModelForPreTraining.from_config(model_config, trust_remote_code=True)
+        processor = AutoProcessor.from_pretrained(
+            model_name_or_path, revision=revision, trust_remote_code=True
+        )
+
+        # copy the remote code next to the weights
+        model_config.register_for_auto_class()
+        model.register_for_auto_class("AutoModelForPreTraining")
+        processor.register_for_auto_class()
+        model.save_pretrained(output_dir)
+        processor.save_pretrained(output_dir)
+
+    return ModelConfig(
+        name=f"{config.name} (tiny)",
+        version=config.version,
+        prompt_template_id=config.prompt_template_id,
+        data={
+            **config.data,
+            "model_name_or_path": str(output_dir),
+            "revision": None,
+            "trust_remote_code": True,
+        },
+        backend=config.backend,
+    )
+
+
+def load_ban_templates() -> dict[str, str]:
+    # same format as the output of LoadBanTagsNode
+    return {
+        path.stem: normalize_tag_text(",".join(load_tags(path)))
+        for path in sorted(BAN_TEMPLATE_DIR.glob("*.txt"))
+    }
+
+
+def format_benchmark_template(model: ModelWrapper) -> str:
+    return model.format_prompt(
+        template_name="translation",
+        format_kwargs={
+            "aspect_ratio": v2408.ASPECT_RATIO_MAP["tall"],
+            "rating": v2408.RATING_MAP["general"],
+            "length": v2408.LENGTH_MAP["long"],
+        },
+    )
+
+
+def benchmark_model(
+    model: ModelWrapper,
+    precision: str,
+    batch_sizes: list[int],
+    max_new_tokens_list: list[int],
+    repeat: int,
+    warmup: int,
+) -> list[BenchmarkResult]:
+    # the deterministic results would be served from the cache after the first run
+    model.result_cache = None
+
+    from .nodes.pipeline import V2408PipelineNode
+
+    results = []
+    pad_token_id = model.processor.decoder_tokenizer.pad_token_id
+    tag_template = format_benchmark_template(model)
+
+    for max_new_tokens in max_new_tokens_list:
+        generation_config = GenerationConfig(
+            do_sample=False,
+            max_new_tokens=max_new_tokens,
+        )
+
+        for batch_size in batch_sizes:
+            text_prompts = [
+                BENCHMARK_PROMPTS[i % len(BENCHMARK_PROMPTS)] for i in range(batch_size)
+            ]
+
+            def generate() -> int:
+                counter = TokenCounter(pad_token_id)
+                model.generate_batch(
+                    text_prompts=text_prompts,
+                    tag_templates=[tag_template],
+                    generation_config=generation_config,
+                    streamer=counter,
+                )
+                return counter.num_tokens
+
+            results.append(
+                measure(
+                    "generate",
+                    {
+                        "precision": precision,
+                        "batch_size": batch_size,
+                        "max_new_tokens": max_new_tokens,
+                    },
+                    generate,
+                    repeat=repeat,
+                    warmup=warmup,
+                )
+            )
+
+        pipeline = V2408PipelineNode()
+
+        def run_pipeline() -> None:
+            asyncio.run(
+                pipeline.generate(
+                    model,
+                    text_prompt=BENCHMARK_PROMPTS[0],
+                    seed=0,
+                    generation_config=generation_config,
+                )
+            )
+
+        results.append(
+            measure(
+                "pipeline",
+                {"precision": precision, "max_new_tokens": max_new_tokens},
+                run_pipeline,
+                repeat=repeat,
+                warmup=warmup,
+            )
+        )
+
+        token_ids = torch.randint(
+            0, len(model.processor.decoder_tokenizer), (max_new_tokens,)
+        )
+
+        def decode_ids() -> None:
+            model.decode_ids(token_ids)
+
+        results.append(
+            measure(
+                "decode_ids",
+                {"precision": precision, "num_tokens": max_new_tokens},
+                decode_ids,
+                repeat=repeat,
+                warmup=warmup,
+            )
+        )
+
+    # built once per model, not part of the lookup
+    vocab_index = model.get_vocab_index()
+    for template_name, ban_tags in load_ban_templates().items():
+
+        def encode_ban_tags() -> None:
+            # the queries are memoized, so the warmup would leave only dict lookups
+            vocab_index.clear_cache()
+            model.encode_ban_tags(ban_tags)
+
+        results.append(
+            measure(
+                "encode_ban_tags",
+                {"precision": precision, "template": template_name},
+                encode_ban_tags,
+                repeat=repeat,
+                warmup=warmup,
+            )
+        )
+
+    return results
+
+
+def generate_outputs(model: ModelWrapper, max_new_tokens: int) -> list[str]:
+    """
+    Greedy outputs of the prompt corpus
+    """
+    model.result_cache = None
+    outputs = model.generate_batch(
+        text_prompts=BENCHMARK_PROMPTS,
+        tag_templates=[format_benchmark_template(model)],
+        generation_config=GenerationConfig(
+            do_sample=False,
+            max_new_tokens=max_new_tokens,
+        ),
+    )
+    return [new for _full, new, _raw in outputs]
+
+
+def tag_overlap(tags: str, reference_tags: str) -> float:
+    """
+    Jaccard similarity of the tag sets
+    """
+    tag_set, reference_set = set(split_tokens(tags)), set(split_tokens(reference_tags))
+    if len(tag_set | reference_set) == 0:
+        return 1.0
+    return len(tag_set & reference_set) / len(tag_set | reference_set)
+
+
+def validate_precisions(
+    config: ModelConfig,
+    precisions: list[str],
+    max_new_tokens: int,
+) -> list[dict[str, Any]]:
+    """
+    Compare the outputs of each precision with the bf16 outputs
+    """
+    model = config.with_precision(VALIDATION_BASELINE_PRECISION).load_model()
+    reference_outputs = generate_outputs(model, max_new_tokens)
+    del model
+
+    results = []
+    for precision in precisions:
+        if precision == VALIDATION_BASELINE_PRECISION:
+            continue
+        model = config.with_precision(precision).load_model()
+        outputs = generate_outputs(model, max_new_tokens)
+        del model
+
+        overlaps = [
+            tag_overlap(output, reference)
+            for output, reference in zip(outputs, reference_outputs)
+        ]
+        results.append(
+            {
+                "precision": precision,
+                "exact_match_rate": statistics.mean(
+                    output == reference
+                    for output, reference in zip(outputs, reference_outputs)
+                ),
+                "mean_tag_overlap": statistics.mean(overlaps),
+                "min_tag_overlap": min(overlaps),
+                "mismatches": [
+                    {"prompt": prompt, "output": output, "reference": reference}
+                    for prompt, output, reference in zip(
+                        BENCHMARK_PROMPTS, outputs, reference_outputs
+                    )
+                    if output != reference
+                ],
+            }
+        )
+
+    return results
+
+
+def compare(
+    results: list[BenchmarkResult],
+    baseline: list[BenchmarkResult],
+    threshold: float,
+) -> list[BenchmarkResult]:
+    """
+    Store the ratios to the baseline in the results and return the regressions
+    """
+    baseline_map = {result.key: result for result in baseline}
+
+    regressions = []
+    for result in results:
+        base = baseline_map.get(result.key)
+        if base is None:
+            continue
+
+        result.comparison["p50_ratio"] = result.p50_ms / base.p50_ms
+        result.comparison["p95_ratio"] = result.p95_ms / base.p95_ms
+        if result.tokens_per_second is not None and base.tokens_per_second:
+            result.comparison["tokens_per_second_ratio"] = (
+                result.tokens_per_second / base.tokens_per_second
+            )
+        if result.comparison["p50_ratio"] > 1 + threshold:
+            regressions.append(result)
+
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark Danbot generation.")
+    parser.add_argument(
+        "--model_name",
+        type=str,
+        help="Model name in models.yml. Defaults to the first model.",
+    )
+    parser.add_argument(
+        "--tiny",
+        action="store_true",
+        help="Use a tiny randomly initialized model with the same tokenizers",
+    )
+    parser.add_argument(
+        "--precisions", type=str, nargs="+", default=["fp32"], choices=PRECISION_TYPES
+    )
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--max_new_tokens", type=int, nargs="+", default=[32, 128])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", type=Path, help="Write the results to a JSON file")
+    parser.add_argument("--baseline", type=Path, help="Results JSON to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative p50 slowdown reported as a regression",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Compare the outputs of --precisions with bf16 instead of measuring speed",
+    )
+    parser.add_argument(
+        "--min_tag_overlap",
+        type=float,
+        default=0.9,
+        help="Lowest mean tag overlap with bf16 accepted by --validate",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    configs = load_models_configs()
+    config = configs[args.model_name or next(iter(configs))]
+    if args.tiny:
+        config = prepare_tiny_model(config)
+
+    if args.validate:
+        validation = validate_precisions(
+            config, args.precisions, max_new_tokens=max(args.max_new_tokens)
+        )
+        failed = False
+        for result in validation:
+            logging.info(
+                f"{result['precision']}: exact match {result['exact_match_rate']:.2f}, "
+                f"mean tag overlap {result['mean_tag_overlap']:.3f}"
+            )
+            if result["mean_tag_overlap"] < args.min_tag_overlap:
+                logging.warning(f"{result['precision']} diverges from bf16")
+                failed = True
+
+        report = json.dumps(
+            {"model": config.name, "validation": validation},
+            indent=2,
+            ensure_ascii=False,
+        )
+        if args.output is not None:
+            args.output.write_text(report, encoding="utf-8")
+        else:
+            print(report)
+        sys.exit(1 if failed else 0)
+
+    results: list[BenchmarkResult] = []
+    for precision in args.precisions:
+        model = config.with_precision(precision).load_model()
+        results.extend(
+            benchmark_model(
+                model,
+                precision=precision,
+                batch_sizes=args.batch_sizes,
+                max_new_tokens_list=args.max_new_tokens,
+                repeat=args.repeat,
+                warmup=args.warmup,
+            )
+        )
+        del model
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = [
+                BenchmarkResult(**result) for result in json.load(file)["results"]
+            ]
+        regressions = compare(results, baseline, args.threshold)
+        for result in regressions:
+            logging.warning(
+                f"Regression in {result.name} {result.params}: "
+                f"p50 x{result.comparison['p50_ratio']:.2f}"
+            )
+
+    report = json.dumps(
+        {
+            "model": config.name,
+            "environment": {
+                "python": platform.python_version(),
+                "torch": torch.__version__,
+                "platform": platform.platform(),
+                "cuda": torch.cuda.is_available(),
+            },
+            "results": [asdict(result) for result in results],
+        },
+        indent=2,
+        ensure_ascii=False,
+    )
+    if args.output is not None:
+        args.output.write_text(report, encoding="utf-8")
+    else:
+        print(report)
+
+    sys.exit(1 if len(regressions) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark of the time ComfyUI takes to register the nodes of this package.
+
+Usage (from this repository):
+    python -m src.benchmark_import --output import_baseline.json
+    python -m src.benchmark_import --baseline import_baseline.json
+
+Exits with 1 if a heavy module is imported at registration or the import got slower.
+"""
+
+from pathlib import Path
+import argparse
+import json
+import logging
+import statistics
+import subprocess
+import sys
+
+PACKAGE_ROOT = Path(__file__).parent.parent
+
+# modules that must be imported only when a node is executed
+HEAVY_MODULES = [
+    "torch",
+    "transformers",
+    "tokenizers",
+    "onnxruntime",
+    "comfy.sd1_clip",
+    "comfy.model_management",
+]
+
+# loads the package the same way as ComfyUI and prints the result as JSON
+IMPORT_SCRIPT = """
+import importlib.util, json, sys, time
+
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location(
+    "danbot_comfy_node", {init!r}, submodule_search_locations=[{root!r}]
+)
+module = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = module
+spec.loader.exec_module(module)
+for node in module.NODE_CLASS_MAPPINGS.values():
+    node.INPUT_TYPES()
+elapsed = time.perf_counter() - start
+
+print(json.dumps({{
+    "import_ms": elapsed * 1000,
+    "heavy_modules": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure_import(repeat: int) -> dict:
+    script = IMPORT_SCRIPT.format(
+        init=str(PACKAGE_ROOT / "__init__.py"),
+        root=str(PACKAGE_ROOT),
+        heavy=HEAVY_MODULES,
+    )
+
+    runs = []
+    for _ in range(repeat):
+        # a fresh interpreter each time, so that nothing is imported beforehand
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    import_ms = sorted(run["import_ms"] for run in runs)
+    return {
+        "p50_ms": statistics.median(import_ms),
+        "max_ms": import_ms[-1],
+        "heavy_modules": sorted({name for run in runs for name in run["heavy_modules"]}),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the node registration time of danbot-comfy-node."
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="Write the result to a JSON file")
+    parser.add_argument("--baseline", type=Path, help="Result JSON to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.5,
+        help="Relative p50 slowdown reported as a regression",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    result = measure_import(args.repeat)
+
+    failed = False
+    if len(result["heavy_modules"]) > 0:
+        logging.error(f"Heavy modules imported at registration: {result['heavy_modules']}")
+        failed = True
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        result["p50_ratio"] = result["p50_ms"] / baseline["p50_ms"]
+        if result["p50_ratio"] > 1 + args.threshold:
+            logging.error(f"Import got slower: p50 x{result['p50_ratio']:.2f}")
+            failed = True
+
+    report = json.dumps(result, indent=2)
+    if args.output is not None:
+        args.output.write_text(report, encoding="utf-8")
+    else:
+        print(report)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
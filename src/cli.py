@@ -0,0 +1,307 @@
+"""
+Expand a dataset of natural language prompts into tags without ComfyUI's UI.
+
+Usage (from this repository, ComfyUI is not required):
+    python -m src.cli "DanbotNL 2408 260M" captions.jsonl tags.jsonl --batch_size 32
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator
+import argparse
+import csv
+import json
+import logging
+import time
+
+from transformers import GenerationConfig, set_seed
+
+from .config import load_models_configs
+from .tags import BAN_TEMPLATE_DIR
+from .models import v2408, PRECISION_TYPES
+from .models.utils import ModelWrapper, BanMask, get_generation_options
+
+# record of the input file
+Row = dict[str, str]
+
+
+def read_rows(path: Path) -> Iterator[Row]:
+    """
+    Read rows from a JSONL or CSV file without loading the whole file
+    """
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        if path.suffix.lower() == ".csv":
+            yield from csv.DictReader(file)
+            return
+
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def chunked(rows: Iterator[Row], size: int) -> Iterator[list[Row]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def format_template(
+    model: ModelWrapper,
+    template_name: v2408.TEMPLATE_NAME,
+    config: v2408.TemplateConfig,
+    **format_kwargs: str,
+) -> str:
+    return model.format_prompt(
+        template_name=template_name,
+        format_kwargs={
+            "aspect_ratio": v2408.ASPECT_RATIO_MAP[config.aspect_ratio],
+            "rating": v2408.RATING_MAP[config.rating],
+            "length": v2408.LENGTH_MAP[config.length],
+            **format_kwargs,
+        },
+    )
+
+
+def expand_batch(
+    model: ModelWrapper,
+    text_prompts: list[str],
+    translation_template_config: v2408.TemplateConfig,
+    extension_template_config: v2408.TemplateConfig,
+    generation_config: GenerationConfig,
+    ban_tags: str | None = None,
+    ban_mask: BanMask | None = None,
+) -> list[dict[str, str]]:
+    """
+    Batched version of the translation and extension stages of V2408PipelineNode
+    """
+    # the encoder output is shared by both stages,
+    # and computed only when a stage is not cached
+    encoded_prompt = model.encode(text_prompts)
+
+    # 1. translate
+    translation_template = format_template(
+        model, "translation", translation_template_config
+    )
+    outputs = model.generate_batch_from_encoded(
+        encoded_prompt,
+        tag_templates=[translation_template] * len(text_prompts),
+        generation_config=GenerationConfig(
+            do_sample=False,
+            max_new_tokens=generation_config.max_new_tokens,
+            **get_generation_options(generation_config),
+        ),
+        ban_tags=ban_tags,
+        ban_mask=ban_mask,
+        stop_token=v2408.TRANSLATION_STOP_TOKENS,
+    )
+    translations = [model.extract_translation_result(raw) for _, _, raw in outputs]
+
+    # 2. extend
+    extension_templates = [
+        format_template(
+            model,
+            "extension",
+            extension_template_config,
+            copyright=translation.get("copyright", ""),
+            character=translation.get("character", ""),
+            translation=translation.get("translation", ""),
+        )
+        for translation in translations
+    ]
+    outputs = model.generate_batch_from_encoded(
+        encoded_prompt,
+        tag_templates=extension_templates,
+        generation_config=generation_config,
+        ban_tags=ban_tags,
+        ban_mask=ban_mask,
+        stop_token=v2408.EXTENSION_STOP_TOKENS,
+    )
+
+    results = []
+    for translation, (_full, _new, raw) in zip(translations, outputs):
+        translated_tags = model.join_tokens(
+            [
+                translation.get("copyright", ""),
+                translation.get("character", ""),
+                translation.get("translation", ""),
+            ]
+        )
+        extended_tags = model.extract_extension_result(raw).get("extension", "")
+        results.append(
+            {
+                "generated_tags": model.join_tokens([translated_tags, extended_tags]),
+                "translated_tags": translated_tags,
+                "extended_tags": extended_tags,
+            }
+        )
+
+    return results
+
+
+def count_lines(path: Path) -> int:
+    if not path.exists():
+        return 0
+    with open(path, "r", encoding="utf-8") as file:
+        return sum(1 for line in file if line.strip())
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Translate and extend prompts of a JSONL or CSV file into Danbooru tags."
+    )
+    parser.add_argument("model_name", type=str, help="Model name in models.yml")
+    parser.add_argument("input", type=Path, help="Input .jsonl or .csv file")
+    parser.add_argument("output", type=Path, help="Output .jsonl file")
+    parser.add_argument(
+        "--prompt_key",
+        type=str,
+        default="text_prompt",
+        help="Key or column of the natural language prompt",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the rows already written to the output file",
+    )
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of batches to generate concurrently",
+    )
+    parser.add_argument("--precision", type=str, choices=PRECISION_TYPES)
+    parser.add_argument(
+        "--aspect_ratio",
+        type=str,
+        default="tall",
+        choices=list(v2408.ASPECT_RATIO_MAP.keys()),
+    )
+    parser.add_argument(
+        "--rating",
+        type=str,
+        default="general",
+        choices=list(v2408.RATING_MAP.keys()),
+    )
+    parser.add_argument(
+        "--translation_length",
+        type=str,
+        default="very_short",
+        choices=list(v2408.LENGTH_MAP.keys()),
+    )
+    parser.add_argument(
+        "--extension_length",
+        type=str,
+        default="long",
+        choices=list(v2408.LENGTH_MAP.keys()),
+    )
+    parser.add_argument("--ban_tags", type=str, help="Comma separated tags to ban")
+    parser.add_argument(
+        "--ban_template",
+        type=str,
+        help="File name of a ban template in tags/ban_template",
+    )
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    parser.add_argument("--do_sample", action="store_true")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument("--top_k", type=int, default=50)
+    parser.add_argument("--min_p", type=float, default=0.05)
+    parser.add_argument("--constrain_structure", action="store_true")
+    parser.add_argument("--suppress_duplicate_tags", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    config = load_models_configs()[args.model_name]
+    if args.precision is not None:
+        config = config.with_precision(args.precision)
+    model = config.load_model()
+
+    translation_template_config = v2408.TemplateConfig(
+        aspect_ratio=args.aspect_ratio,
+        rating=args.rating,
+        length=args.translation_length,
+    )
+    extension_template_config = v2408.TemplateConfig(
+        aspect_ratio=args.aspect_ratio,
+        rating=args.rating,
+        length=args.extension_length,
+    )
+    generation_config = GenerationConfig(
+        max_new_tokens=args.max_new_tokens,
+        do_sample=args.do_sample,
+        temperature=args.temperature,
+        top_p=args.top_p,
+        top_k=args.top_k,
+        min_p=args.min_p,
+        # danbot specific options
+        constrain_structure=args.constrain_structure,
+        suppress_duplicate_tags=args.suppress_duplicate_tags,
+    )
+    ban_mask = (
+        model.compile_ban_template(BAN_TEMPLATE_DIR / args.ban_template)
+        if args.ban_template is not None
+        else None
+    )
+    set_seed(args.seed)
+
+    rows = read_rows(args.input)
+    num_skipped = count_lines(args.output) if args.resume else 0
+    for _ in range(num_skipped):
+        next(rows, None)
+    if num_skipped > 0:
+        logging.info(f"Skipped {num_skipped} rows already in {args.output}")
+
+    def expand(chunk: list[Row]) -> list[Row]:
+        results = expand_batch(
+            model,
+            text_prompts=[row[args.prompt_key] for row in chunk],
+            translation_template_config=translation_template_config,
+            extension_template_config=extension_template_config,
+            generation_config=generation_config,
+            ban_tags=args.ban_tags,
+            ban_mask=ban_mask,
+        )
+        return [{**row, **result} for row, result in zip(chunk, results)]
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    num_done = 0
+    start = time.perf_counter()
+    with (
+        open(args.output, "a" if args.resume else "w", encoding="utf-8") as file,
+        ThreadPoolExecutor(max_workers=args.num_workers) as executor,
+    ):
+
+        def write(future: Future[list[Row]]):
+            nonlocal num_done
+            for row in future.result():
+                file.write(json.dumps(row, ensure_ascii=False) + "\n")
+            file.flush()
+
+            num_done += len(future.result())
+            elapsed = time.perf_counter() - start
+            logging.info(f"{num_done} rows done ({num_done / elapsed:.2f} rows/s)")
+
+        # results are written in the input order, so that --resume can skip by count
+        pending: list[Future[list[Row]]] = []
+        for chunk in chunked(rows, args.batch_size):
+            pending.append(executor.submit(expand, chunk))
+            while len(pending) > args.num_workers:
+                write(pending.pop(0))
+        for future in pending:
+            write(future)
+
+
+if __name__ == "__main__":
+    main()
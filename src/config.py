@@ -1,59 +1,184 @@
+import hashlib
+import json
 import os
 from pathlib import Path
+from typing import TYPE_CHECKING
 import yaml
 from dataclasses import dataclass
 
-from .models import (
-    ModelWrapper,
-    MODEL_VERSIONS,
-    MODEL_VERSION_TO_CLASS,
-)
+from .file_cache import CachedFile
+from .models.metadata import MODEL_VERSIONS, MODEL_BACKENDS, PRECISION_TYPE
+from .models.registry import ModelKey
+from .models.executor import GenerationExecutor, BATCH_WINDOW_MS, MAX_BATCH_SIZE
+
+if TYPE_CHECKING:
+    from .models.utils import ModelWrapper
 
 SELF_PATH_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
 CONFIG_ROOT_DIR = SELF_PATH_DIR / ".." / "config"
 
 MODELS_CONFIG_FILE_PATH = CONFIG_ROOT_DIR / "models.yml"
 PROMPT_TEMPLATE_CONFIG_FILE_PATH = CONFIG_ROOT_DIR / "prompt_templates.yml"
+EXECUTOR_CONFIG_FILE_PATH = CONFIG_ROOT_DIR / "executor.yml"
 
 
 @dataclass
 class ModelConfig:
+    name: str
     version: MODEL_VERSIONS
     prompt_template_id: str
 
     data: dict[str, str]
 
-    def load_model(self) -> ModelWrapper:
-        model_cls = MODEL_VERSION_TO_CLASS[self.version]
+    backend: MODEL_BACKENDS = "torch"
+
+    @property
+    def precision(self) -> PRECISION_TYPE:
+        return self.data.get("precision", "bf16")  # type: ignore
+
+    def with_precision(self, precision: PRECISION_TYPE) -> "ModelConfig":
+        return ModelConfig(
+            name=self.name,
+            version=self.version,
+            prompt_template_id=self.prompt_template_id,
+            data={**self.data, "precision": precision},
+            backend=self.backend,
+        )
+
+    def config_hash(self) -> str:
+        """
+        Hash of the config entry and its prompt templates.
+        Models are loaded again when it changes.
+        """
+        text = json.dumps(
+            {
+                "version": self.version,
+                "backend": self.backend,
+                "data": self.data,
+                "prompt_templates": load_prompt_templates()[self.prompt_template_id],
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def load_model(self) -> "ModelWrapper":
+        from .models import MODEL_VERSION_TO_CLASS, MODEL_VERSION_TO_ONNX_CLASS
+
+        model_cls = (
+            MODEL_VERSION_TO_ONNX_CLASS[self.version]
+            if self.backend == "onnx"
+            else MODEL_VERSION_TO_CLASS[self.version]
+        )
         prompt_templates = load_prompt_templates()
         prompt_template = prompt_templates[self.prompt_template_id]
         return model_cls(prompt_templates=prompt_template, **self.data)
 
+    def cache_key(self) -> ModelKey:
+        from .models.device import get_torch_device
+
+        return (
+            self.name,
+            self.data.get("revision"),
+            self.precision,
+            (
+                "cpu"
+                if self.backend == "onnx" or self.precision == "int8"
+                else str(get_torch_device())
+            ),
+            self.config_hash(),
+        )
+
 
 # id: dict[name, template] pair
 PromptTemplates = dict[str, dict[str, str]]
 
 
-def load_models_configs() -> dict[str, ModelConfig]:
-    with open(MODELS_CONFIG_FILE_PATH, "r") as file:
-        models_configs: list[dict] = yaml.safe_load(file)
+def parse_models_configs(text: str) -> dict[str, ModelConfig]:
+    models_configs: list[dict] = yaml.safe_load(text)
 
-    return {
-        model_config.pop("name"): ModelConfig(
+    configs = [
+        ModelConfig(
+            name=model_config.pop("name"),
             version=model_config.pop("version"),
             prompt_template_id=model_config.pop("prompt_template_id"),
+            backend=model_config.pop("backend", "torch"),
             data=model_config,
         )
         for model_config in models_configs
-    }
+    ]
 
+    return {config.name: config for config in configs}
 
-def load_prompt_templates() -> PromptTemplates:
-    with open(PROMPT_TEMPLATE_CONFIG_FILE_PATH, "r") as file:
-        config: dict[str, dict[str, str]] = yaml.safe_load(file)
+
+def parse_prompt_templates(text: str) -> PromptTemplates:
+    config: dict[str, dict[str, str]] = yaml.safe_load(text)
 
     # remove all newlines
     return {
         id: {name: template.replace("\n", "") for name, template in templates.items()}
         for id, templates in config.items()
     }
+
+
+# parsed again only when the files change
+MODELS_CONFIG_FILE = CachedFile(MODELS_CONFIG_FILE_PATH, parse_models_configs)
+PROMPT_TEMPLATE_CONFIG_FILE = CachedFile(
+    PROMPT_TEMPLATE_CONFIG_FILE_PATH, parse_prompt_templates
+)
+
+
+def load_models_configs() -> dict[str, ModelConfig]:
+    # copy, so that the callers can not modify the cache
+    return dict(MODELS_CONFIG_FILE.get())
+
+
+def load_prompt_templates() -> PromptTemplates:
+    return {
+        id: dict(templates)
+        for id, templates in PROMPT_TEMPLATE_CONFIG_FILE.get().items()
+    }
+
+
+def models_configs_hash() -> str:
+    """
+    Content hash of the files the loaded models depend on
+    """
+    return (
+        MODELS_CONFIG_FILE.content_hash + PROMPT_TEMPLATE_CONFIG_FILE.content_hash
+    )
+
+
+@dataclass
+class ExecutorConfig:
+    enabled: bool = False
+    num_workers: int = 1
+    batch_window_ms: float = BATCH_WINDOW_MS
+    max_batch_size: int = MAX_BATCH_SIZE
+
+    def create_executor(self) -> GenerationExecutor | None:
+        if not self.enabled:
+            return None
+
+        return GenerationExecutor(
+            num_workers=self.num_workers,
+            batch_window_ms=self.batch_window_ms,
+            max_batch_size=self.max_batch_size,
+        )
+
+
+def parse_executor_config(text: str) -> ExecutorConfig:
+    config: dict | None = yaml.safe_load(text)
+
+    return ExecutorConfig(**(config or {}))
+
+
+EXECUTOR_CONFIG_FILE = CachedFile(EXECUTOR_CONFIG_FILE_PATH, parse_executor_config)
+
+
+def load_executor_config() -> ExecutorConfig:
+    if not EXECUTOR_CONFIG_FILE_PATH.exists():
+        return ExecutorConfig()
+
+    return EXECUTOR_CONFIG_FILE.get()
@@ -0,0 +1,83 @@
+from pathlib import Path
+from typing import Callable, Generic, TypeVar
+import hashlib
+import os
+import threading
+
+T = TypeVar("T")
+
+
+class CachedFile(Generic[T]):
+    """
+    Parsed content of a file, reloaded only when the file changes.
+
+    The file is re-read when its mtime or size changes,
+    and re-parsed only when the content hash changes too.
+    """
+
+    def __init__(self, path: str | Path, parse: Callable[[str], T]):
+        self.path = Path(path)
+        self.parse = parse
+
+        self._signature: tuple[int, int] | None = None  # (mtime_ns, size)
+        self._content_hash: str | None = None
+        self._value: T | None = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        stat = os.stat(self.path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return
+
+        data = self.path.read_bytes()
+        content_hash = hashlib.sha256(data).hexdigest()
+        if content_hash != self._content_hash:
+            self._value = self.parse(data.decode("utf-8"))
+            self._content_hash = content_hash
+        self._signature = signature
+
+    def get(self) -> T:
+        with self._lock:
+            self._refresh()
+            return self._value  # type: ignore
+
+    @property
+    def content_hash(self) -> str:
+        with self._lock:
+            self._refresh()
+            return self._content_hash  # type: ignore
+
+
+class CachedDirectory:
+    """
+    File names in a directory, listed again only when the directory's mtime changes
+    """
+
+    def __init__(self, path: str | Path, suffix: str = ""):
+        self.path = Path(path)
+        self.suffix = suffix
+
+        self._mtime_ns: int | None = None
+        self._files: list[str] = []
+        self._cached_files: dict[str, CachedFile] = {}
+        self._lock = threading.Lock()
+
+    def list_files(self) -> list[str]:
+        with self._lock:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+            if mtime_ns != self._mtime_ns:
+                self._files = sorted(
+                    file for file in os.listdir(self.path) if file.endswith(self.suffix)
+                )
+                self._mtime_ns = mtime_ns
+            return list(self._files)
+
+    def file(self, name: str, parse: Callable[[str], T]) -> CachedFile[T]:
+        """
+        Returns the cached file in this directory. `parse` is used on the first call for the name.
+        """
+        with self._lock:
+            if name not in self._cached_files:
+                self._cached_files[name] = CachedFile(self.path / name, parse)
+            return self._cached_files[name]
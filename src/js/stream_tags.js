@@ -0,0 +1,29 @@
+import { app } from "../../../scripts/app.js";
+import { api } from "../../../scripts/api.js";
+import { ComfyWidgets } from "../../../scripts/widgets.js";
+
+const WIDGET_NAME = "streamed_tags";
+
+// Displays the tags on the generator node while they are being generated
+app.registerExtension({
+    name: "danbot-comfy-node.StreamTags",
+    async setup() {
+        api.addEventListener("danbot.stream", ({ detail }) => {
+            const node = app.graph.getNodeById(+detail.node);
+            if (!node) {
+                return;
+            }
+
+            let widget = node.widgets?.find((w) => w.name === WIDGET_NAME);
+            if (!widget) {
+                widget = ComfyWidgets["STRING"](node, WIDGET_NAME, ["STRING", { multiline: true }], app).widget;
+                widget.inputEl.readOnly = true;
+                widget.serialize = false;
+            }
+            widget.value = detail.text;
+            widget.inputEl.style.opacity = detail.done ? 0.6 : 1.0;
+
+            app.graph.setDirtyCanvas(true, false);
+        });
+    },
+});
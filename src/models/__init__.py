@@ -1,6 +1,44 @@
-from .v2408 import V2408Model
-from .utils import ModelWrapper, MODEL_VERSIONS
+from typing import Any
 
-MODEL_VERSION_TO_CLASS: dict[MODEL_VERSIONS, type[ModelWrapper]] = {
-    "v2408": V2408Model,
-}
+from .metadata import (
+    MODEL_VERSIONS,
+    MODEL_BACKENDS,
+    PRECISION_TYPE,
+    PRECISION_TYPES,
+)
+
+# the model classes import torch and transformers,
+# so they are loaded on first access to keep the node registration fast
+_LAZY_ATTRIBUTES = [
+    "V2408Model",
+    "V2408OnnxModel",
+    "ModelWrapper",
+    "MODEL_VERSION_TO_CLASS",
+    "MODEL_VERSION_TO_ONNX_CLASS",
+]
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    from .utils import ModelWrapper
+    from .v2408 import V2408Model
+    from .v2408_onnx import V2408OnnxModel
+
+    model_version_to_class: dict[MODEL_VERSIONS, type[ModelWrapper]] = {
+        "v2408": V2408Model,
+    }
+    model_version_to_onnx_class: dict[MODEL_VERSIONS, type[ModelWrapper]] = {
+        "v2408": V2408OnnxModel,
+    }
+    attributes = {
+        "V2408Model": V2408Model,
+        "V2408OnnxModel": V2408OnnxModel,
+        "ModelWrapper": ModelWrapper,
+        "MODEL_VERSION_TO_CLASS": model_version_to_class,
+        "MODEL_VERSION_TO_ONNX_CLASS": model_version_to_onnx_class,
+    }
+    globals().update(attributes)  # cache for the next access
+
+    return attributes[name]
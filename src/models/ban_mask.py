@@ -0,0 +1,191 @@
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from ..file_cache import CachedFile
+from ..tags import parse_tags
+
+if TYPE_CHECKING:
+    import torch
+
+COMPILED_DIR_NAME = ".compiled"
+# bumped when the tags of the templates are encoded differently, e.g. normalized
+COMPILED_MASK_VERSION = 2
+
+
+def vocab_hash(vocab: dict[str, int]) -> str:
+    """
+    Hash of a tokenizer vocabulary. Compiled ban masks are valid only for the same hash.
+    """
+    text = json.dumps(sorted(vocab.items()), ensure_ascii=False)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class BanMask:
+    """
+    Bitset of the banned token ids of a tokenizer vocabulary.
+    Bit `i` of the packed bytes (little bit order) is set if token `i` is banned.
+    """
+
+    def __init__(self, bits: np.ndarray, vocab_size: int, vocab_hash: str):
+        assert bits.dtype == np.uint8 and bits.shape == ((vocab_size + 7) // 8,), (
+            f"Bits of shape {bits.shape} do not match the vocab size {vocab_size}."
+        )
+        self.bits = bits
+        self.vocab_size = vocab_size
+        self.vocab_hash = vocab_hash
+
+        self._tensor: "torch.Tensor | None" = None
+        self._digest: str | None = None
+
+    @classmethod
+    def from_token_ids(
+        cls, token_ids: list[int], vocab_size: int, vocab_hash: str
+    ) -> "BanMask":
+        mask = np.zeros(vocab_size, dtype=bool)
+        mask[token_ids] = True
+        return cls(np.packbits(mask, bitorder="little"), vocab_size, vocab_hash)
+
+    @classmethod
+    def empty(cls, vocab_size: int, vocab_hash: str) -> "BanMask":
+        bits = np.zeros((vocab_size + 7) // 8, dtype=np.uint8)
+        return cls(bits, vocab_size, vocab_hash)
+
+    @classmethod
+    def load(cls, path: str | Path, vocab_size: int, vocab_hash: str) -> "BanMask":
+        # memory-mapped, so the page cache is shared by all processes
+        return cls(np.load(path, mmap_mode="r"), vocab_size, vocab_hash)
+
+    def save(self, path: str | Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # written to a temporary file first, so other processes never see a partial file
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(temp_path, "wb") as file:
+            np.save(file, np.asarray(self.bits))
+        os.replace(temp_path, path)
+
+    def _check_compatible(self, other: "BanMask"):
+        assert self.vocab_hash == other.vocab_hash, (
+            "Ban masks compiled for different tokenizers can not be combined."
+        )
+
+    def union(self, other: "BanMask") -> "BanMask":
+        self._check_compatible(other)
+        return BanMask(self.bits | other.bits, self.vocab_size, self.vocab_hash)
+
+    def difference(self, other: "BanMask") -> "BanMask":
+        self._check_compatible(other)
+        return BanMask(self.bits & ~other.bits, self.vocab_size, self.vocab_hash)
+
+    def intersection(self, other: "BanMask") -> "BanMask":
+        self._check_compatible(other)
+        return BanMask(self.bits & other.bits, self.vocab_size, self.vocab_hash)
+
+    __or__ = union
+    __sub__ = difference
+    __and__ = intersection
+
+    def is_empty(self) -> bool:
+        return not self.bits.any()
+
+    def token_ids(self) -> list[int]:
+        mask = np.unpackbits(self.bits, count=self.vocab_size, bitorder="little")
+        return np.flatnonzero(mask).tolist()
+
+    def to_tensor(self) -> "torch.Tensor":
+        """
+        Returns the boolean mask of shape (vocab_size,)
+        """
+        if self._tensor is None:
+            import torch
+
+            mask = np.unpackbits(self.bits, count=self.vocab_size, bitorder="little")
+            self._tensor = torch.from_numpy(mask.astype(bool))
+        return self._tensor
+
+    @property
+    def digest(self) -> str:
+        if self._digest is None:
+            self._digest = hashlib.sha256(np.asarray(self.bits).tobytes()).hexdigest()
+        return self._digest
+
+    def __str__(self) -> str:
+        # used in the result cache keys
+        return f"BanMask({self.digest})"
+
+
+def compiled_mask_path(template_path: Path, file_hash: str, vocab_hash: str) -> Path:
+    name = f"{template_path.stem}.{file_hash[:16]}.{vocab_hash[:16]}.v{COMPILED_MASK_VERSION}"
+    return template_path.parent / COMPILED_DIR_NAME / f"{name}.npy"
+
+
+def _remove_stale_masks(template_path: Path, compiled_path: Path, vocab_hash: str):
+    # the masks of the older contents of the template, or of the older mask versions
+    for path in compiled_path.parent.glob(f"{template_path.stem}.*.npy"):
+        # {file_hash}.{vocab_hash}[.v{version}].npy
+        parts = path.name[len(template_path.stem) + 1 :].split(".")
+        if (
+            len(parts) in (3, 4)
+            and parts[1] == vocab_hash[:16]
+            and path != compiled_path
+        ):
+            path.unlink(missing_ok=True)
+
+
+_template_files: dict[Path, CachedFile[list[str]]] = {}
+# (template path, file hash, vocab hash) -> mask
+_template_masks: dict[tuple[Path, str, str], BanMask] = {}
+_lock = threading.Lock()
+
+
+def load_ban_template_mask(
+    template_path: str | Path,
+    vocab_size: int,
+    vocab_hash: str,
+    encode_tags: Callable[[list[str]], list[int]],
+) -> BanMask:
+    """
+    Returns the compiled ban mask of the template file.
+    The mask is compiled with `encode_tags` once per content of the file and vocab,
+    and saved next to the template.
+    """
+    template_path = Path(template_path).resolve()
+    with _lock:
+        if template_path not in _template_files:
+            _template_files[template_path] = CachedFile(template_path, parse_tags)
+        template_file = _template_files[template_path]
+
+        file_hash = template_file.content_hash
+        key = (template_path, file_hash, vocab_hash)
+        if key in _template_masks:
+            return _template_masks[key]
+
+        compiled_path = compiled_mask_path(template_path, file_hash, vocab_hash)
+        mask = None
+        if compiled_path.exists():
+            try:
+                mask = BanMask.load(compiled_path, vocab_size, vocab_hash)
+            except Exception as e:
+                logging.warning(f"Failed to load {compiled_path}, compiling again: {e}")
+        if mask is None:
+            token_ids = encode_tags(template_file.get())
+            mask = BanMask.from_token_ids(token_ids, vocab_size, vocab_hash)
+            try:
+                mask.save(compiled_path)
+                _remove_stale_masks(template_path, compiled_path, vocab_hash)
+            except OSError as e:
+                logging.warning(f"Failed to save the compiled ban mask: {e}")
+
+        for old_key in list(_template_masks):
+            if old_key[0] == template_path and old_key[2] == vocab_hash:
+                del _template_masks[old_key]
+        _template_masks[key] = mask
+        return mask
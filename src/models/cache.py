@@ -0,0 +1,106 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Generic, Hashable, TypeVar
+import hashlib
+import json
+import sqlite3
+import threading
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    Thread-safe in-memory LRU cache
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+
+        self._data: OrderedDict[K, V] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key: K, value: V):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key: K) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# (full, completion, raw)
+GenerationResult = tuple[str, str, str]
+
+
+class ResultCache:
+    """
+    Cache of deterministic generation results.
+    Kept in memory with LRU eviction, and optionally persisted to a SQLite file
+    so that the results survive server restarts.
+    """
+
+    def __init__(self, max_size: int, path: str | Path | None = None):
+        self.memory: LRUCache[str, GenerationResult] = LRUCache(max_size=max_size)
+
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db_lock:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS results "
+                    "(key TEXT PRIMARY KEY, full TEXT, completion TEXT, raw TEXT)"
+                )
+                self._db.commit()
+
+    @staticmethod
+    def make_key(**fields: Any) -> str:
+        text = json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> GenerationResult | None:
+        result = self.memory.get(key)
+        if result is not None or self._db is None:
+            return result
+
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT full, completion, raw FROM results WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        result = (row[0], row[1], row[2])
+        self.memory.put(key, result)
+        return result
+
+    def put(self, key: str, result: GenerationResult):
+        self.memory.put(key, result)
+
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                    (key, *result),
+                )
+                self._db.commit()
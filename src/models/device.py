@@ -0,0 +1,49 @@
+"""
+Devices of ComfyUI's model management, with fallbacks when running outside of ComfyUI
+(the batch CLI, the benchmark and the ONNX export).
+This module must not import torch or comfy at the module level.
+"""
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import torch
+
+
+def is_comfy_available() -> bool:
+    try:
+        import comfy.model_management  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_torch_device() -> "torch.device":
+    import torch
+
+    if is_comfy_available():
+        from comfy.model_management import get_torch_device
+
+        return get_torch_device()
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def get_offload_device() -> "torch.device":
+    import torch
+
+    if is_comfy_available():
+        from comfy.model_management import text_encoder_offload_device
+
+        return text_encoder_offload_device()
+    return torch.device("cpu")
+
+
+def soft_empty_cache():
+    import torch
+
+    if is_comfy_available():
+        from comfy.model_management import soft_empty_cache
+
+        soft_empty_cache()
+    elif torch.cuda.is_available():
+        torch.cuda.empty_cache()
@@ -0,0 +1,356 @@
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, TYPE_CHECKING
+import contextvars
+import logging
+import queue
+import threading
+import time
+
+from .cache import ResultCache, GenerationResult
+
+if TYPE_CHECKING:
+    from transformers import GenerationConfig
+
+    from .utils import ModelWrapper, EncodedPrompt
+
+BATCH_WINDOW_MS = 10
+MAX_BATCH_SIZE = 16
+
+# kwargs that hold per-request state, so that the request cannot share a batch
+UNBATCHABLE_KWARGS = ["logits_processor"]
+# kwargs that are given to each request of a batch separately
+PER_REQUEST_KWARGS = ["streamer"]
+
+
+@dataclass
+class GenerationRequest:
+    model: "ModelWrapper"
+    text_prompts: list[str]  # one prompt for all templates, or one per template
+    tag_templates: list[str]
+    generation_config: "GenerationConfig"
+    kwargs: dict[str, Any]
+
+    seed: int | None = None
+    encoded_prompt: "EncodedPrompt | None" = None
+    # samples the variants of the prompt with seed + i, see `ModelWrapper.generate_variants`
+    num_variants: int | None = None
+
+    future: Future = field(default_factory=Future)
+    # context of the submitter, e.g. the metrics being collected
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+
+    @property
+    def num_rows(self) -> int:
+        if self.num_variants is not None:
+            return self.num_variants
+        return max(len(self.text_prompts), len(self.tag_templates))
+
+    def rows(self) -> list[tuple[str, str]]:
+        """
+        Returns the (text prompt, tag template) of each row
+        """
+        text_prompts, tag_templates = self.text_prompts, self.tag_templates
+        if len(text_prompts) == 1:
+            text_prompts = text_prompts * self.num_rows
+        if len(tag_templates) == 1:
+            tag_templates = tag_templates * self.num_rows
+        assert len(text_prompts) == len(tag_templates), (
+            f"Number of prompts ({len(text_prompts)}) and templates ({len(tag_templates)}) mismatch."
+        )
+        return list(zip(text_prompts, tag_templates))
+
+    def batch_key(self) -> str | None:
+        """
+        Requests with the same key can be generated in one batch.
+        Returns None when the request must run alone.
+        """
+        if self.num_variants is not None:
+            return None
+        # the rows of a batch share the random state, so the seed would not be reproducible
+        if self.generation_config.do_sample:
+            return None
+        if any(self.kwargs.get(name) is not None for name in UNBATCHABLE_KWARGS):
+            return None
+
+        encoded_text_prompt = None
+        if self.encoded_prompt is not None:
+            # the encoder output is shared by the requests of the same prompt
+            if len(self.encoded_prompt.text_prompts) != 1:
+                return None
+            encoded_text_prompt = self.encoded_prompt.text_prompts[0]
+
+        return ResultCache.make_key(
+            model=id(self.model),
+            encoded_text_prompt=encoded_text_prompt,
+            generation_config=self.generation_config.to_diff_dict(),
+            **self.shared_kwargs(),
+        )
+
+    def shared_kwargs(self) -> dict[str, Any]:
+        """
+        Returns the kwargs shared by the requests of a batch, e.g. ban_tags and stop_token
+        """
+        return {
+            name: value
+            for name, value in self.kwargs.items()
+            if name not in PER_REQUEST_KWARGS
+        }
+
+
+class GenerationExecutor:
+    """
+    Background workers that run the generation requests of all nodes.
+
+    Requests submitted within `batch_window_ms` of each other are coalesced into
+    one `generate_batch` call of up to `max_batch_size` rows when they use the same
+    model and options. The requests reusing an encoder output are coalesced by prompt,
+    and larger requests are split into batches of `max_batch_size` rows.
+    """
+
+    def __init__(
+        self,
+        num_workers: int = 1,
+        batch_window_ms: float = BATCH_WINDOW_MS,
+        max_batch_size: int = MAX_BATCH_SIZE,
+    ):
+        assert num_workers >= 1, "num_workers must be at least 1"
+        assert max_batch_size >= 1, "max_batch_size must be at least 1"
+
+        self.num_workers = num_workers
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+
+        self._queue: queue.Queue[GenerationRequest | None] = queue.Queue()
+        self._workers: list[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        model: "ModelWrapper",
+        text_prompts: list[str],
+        tag_templates: list[str],
+        generation_config: "GenerationConfig",
+        seed: int | None = None,
+        encoded_prompt: "EncodedPrompt | None" = None,
+        num_variants: int | None = None,
+        **kwargs,
+    ) -> "Future[list[GenerationResult]]":
+        """
+        Queue a generation request and return the future of its (full, completion, raw) results.
+        When `encoded_prompt` is given, the encoder output is reused instead of encoding `text_prompts`.
+        """
+        self._start()
+
+        request = GenerationRequest(
+            model=model,
+            text_prompts=text_prompts,
+            tag_templates=tag_templates,
+            generation_config=generation_config,
+            kwargs=kwargs,
+            seed=seed,
+            encoded_prompt=encoded_prompt,
+            num_variants=num_variants,
+        )
+        self._queue.put(request)
+
+        return request.future
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            workers, self._workers = self._workers, []
+            for _ in workers:
+                self._queue.put(None)
+
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def _start(self):
+        with self._lock:
+            if len(self._workers) > 0:
+                return
+
+            for i in range(self.num_workers):
+                worker = threading.Thread(
+                    target=self._work,
+                    name=f"danbot-generation-{i}",
+                    daemon=True,
+                )
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+
+            requests = [request]
+            try:
+                requests = self._collect(request)
+                for batch in self._group(requests):
+                    self._run(batch)
+            except Exception as e:
+                # keep the worker alive, and never leave a request waiting
+                logging.exception("Generation worker failed")
+                for request in requests:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _collect(self, first: GenerationRequest) -> list[GenerationRequest]:
+        # wait for the other requests arriving within the window
+        requests = [first]
+        num_rows = first.num_rows
+        deadline = time.monotonic() + self.batch_window
+        while num_rows < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # leave the shutdown signal to the next loop
+                self._queue.put(None)
+                break
+            requests.append(request)
+            num_rows += request.num_rows
+
+        return requests
+
+    def _group(
+        self, requests: list[GenerationRequest]
+    ) -> list[list[GenerationRequest]]:
+        batches: dict[str, list[list[GenerationRequest]]] = {}
+        singles: list[list[GenerationRequest]] = []
+        for request in requests:
+            key = request.batch_key()
+            if key is None:
+                singles.append([request])
+                continue
+
+            # a new batch is started when the rows would exceed max_batch_size
+            key_batches = batches.setdefault(key, [[]])
+            num_rows = sum(queued.num_rows for queued in key_batches[-1])
+            if key_batches[-1] and num_rows + request.num_rows > self.max_batch_size:
+                key_batches.append([])
+            key_batches[-1].append(request)
+
+        return [
+            *(batch for key_batches in batches.values() for batch in key_batches),
+            *singles,
+        ]
+
+    def _run(self, requests: list[GenerationRequest]):
+        requests = [
+            request
+            for request in requests
+            if request.future.set_running_or_notify_cancel()
+        ]
+        if len(requests) == 0:
+            return
+
+        # coalesced requests report to the context of the first one
+        first = requests[0]
+        try:
+            results = first.context.run(self._generate, requests)
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+            return
+
+        for request, result in zip(requests, results):
+            request.future.set_result(result)
+
+    def _generate(
+        self, requests: list[GenerationRequest]
+    ) -> list[list[GenerationResult]]:
+        from transformers import set_seed
+
+        first = requests[0]
+        if first.seed is not None:
+            set_seed(first.seed)
+
+        if first.num_variants is not None:
+            assert first.seed is not None, "Variants need a seed."
+            # the i-th variant uses seed + i, so the variants can be split
+            variants = []
+            for start in range(0, first.num_variants, self.max_batch_size):
+                variants.extend(
+                    first.model.generate_variants(
+                        first.text_prompts[0],
+                        tag_template=first.tag_templates[0],
+                        generation_config=first.generation_config,
+                        seed=first.seed + start,
+                        num_variants=min(
+                            self.max_batch_size, first.num_variants - start
+                        ),
+                        **first.kwargs,
+                    )
+                )
+            return [variants]
+
+        logging.debug(f"Generating {len(requests)} coalesced requests")
+        rows = [row for request in requests for row in request.rows()]
+        # the streamer of each request is given its first row
+        streamers: list[Any] = []
+        for request in requests:
+            streamers.append(request.kwargs.get("streamer"))
+            streamers.extend([None] * (request.num_rows - 1))
+
+        # requests larger than max_batch_size are split
+        results = []
+        for start in range(0, len(rows), self.max_batch_size):
+            end = min(start + self.max_batch_size, len(rows))
+            results.extend(
+                self._generate_rows(first, rows, streamers, list(range(start, end)))
+            )
+
+        # split the rows back into the requests
+        outputs, start = [], 0
+        for request in requests:
+            outputs.append(results[start : start + request.num_rows])
+            start += request.num_rows
+        return outputs
+
+    def _generate_rows(
+        self,
+        first: GenerationRequest,
+        rows: list[tuple[str, str]],  # (text prompt, tag template) of all rows
+        streamers: list[Any],
+        indices: list[int],
+    ) -> list[GenerationResult]:
+        kwargs = first.shared_kwargs()
+        chunk_streamers = [streamers[i] for i in indices]
+        if any(streamer is not None for streamer in chunk_streamers):
+            from .streamer import RowStreamers
+
+            kwargs["streamer"] = RowStreamers(chunk_streamers)
+
+        tag_templates = [rows[i][1] for i in indices]
+        if first.encoded_prompt is not None:
+            # the requests of a batch share the prompt, see `GenerationRequest.batch_key`
+            encoded_prompt = first.encoded_prompt
+            if len(encoded_prompt.text_prompts) > 1 and len(indices) < len(rows):
+                encoded_prompt = encoded_prompt.select(indices)
+            return first.model.generate_batch_from_encoded(
+                encoded_prompt,
+                tag_templates=tag_templates,
+                generation_config=first.generation_config,
+                **kwargs,
+            )
+
+        return first.model.generate_batch(
+            text_prompts=[rows[i][0] for i in indices],
+            tag_templates=tag_templates,
+            generation_config=first.generation_config,
+            **kwargs,
+        )
@@ -0,0 +1,210 @@
+import torch
+from transformers import (
+    GenerationConfig,
+    LogitsProcessor,
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+    MinPLogitsWarper,
+)
+
+
+def build_logits_warpers(generation_config: GenerationConfig) -> LogitsProcessorList:
+    """
+    Build the sampling logits warpers in the same order as transformers' generate()
+    """
+    warpers = LogitsProcessorList()
+    if not generation_config.do_sample:
+        return warpers
+
+    if generation_config.temperature is not None and generation_config.temperature != 1.0:
+        warpers.append(TemperatureLogitsWarper(generation_config.temperature))
+    if generation_config.top_k is not None and generation_config.top_k != 0:
+        warpers.append(TopKLogitsWarper(top_k=generation_config.top_k))
+    if generation_config.top_p is not None and generation_config.top_p < 1.0:
+        warpers.append(TopPLogitsWarper(top_p=generation_config.top_p))
+    if generation_config.min_p is not None and generation_config.min_p > 0.0:
+        warpers.append(MinPLogitsWarper(min_p=generation_config.min_p))
+
+    return warpers
+
+
+class BanTokensLogitsProcessor(LogitsProcessor):
+    """
+    Masks out the banned tokens with a precompiled boolean vocab mask
+    """
+
+    def __init__(self, ban_mask: torch.Tensor):
+        self.ban_mask = ban_mask  # (vocab_size,)
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        vocab_size = scores.size(-1)
+        if self.ban_mask.size(0) != vocab_size or self.ban_mask.device != scores.device:
+            # the model vocab may be padded larger than the tokenizer vocab
+            ban_mask = torch.zeros(vocab_size, dtype=torch.bool, device=scores.device)
+            num_tokens = min(vocab_size, self.ban_mask.size(0))
+            ban_mask[:num_tokens] = self.ban_mask[:num_tokens]
+            self.ban_mask = ban_mask
+
+        return scores.masked_fill(self.ban_mask, -float("inf"))  # type: ignore
+
+
+class PerRowSamplingLogitsProcessor(LogitsProcessor):
+    """
+    Samples the next token of each row with its own seeded generator,
+    so that each row is reproducible regardless of the batch composition.
+    Must be the last processor, and used with greedy decoding:
+    all tokens except the sampled one are masked out.
+    """
+
+    def __init__(self, seeds: list[int], logits_warper: LogitsProcessorList):
+        self.seeds = seeds
+        self.logits_warper = logits_warper
+        self.generators: list[torch.Generator] | None = None
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        assert scores.size(0) == len(self.seeds), (
+            f"Number of rows ({scores.size(0)}) and seeds ({len(self.seeds)}) mismatch."
+        )
+        if self.generators is None:
+            self.generators = [
+                torch.Generator(device=scores.device).manual_seed(seed)
+                for seed in self.seeds
+            ]
+
+        scores = self.logits_warper(input_ids, scores)  # type: ignore
+        probs = torch.softmax(scores.float(), dim=-1)
+        next_tokens = torch.cat(
+            [
+                torch.multinomial(probs[i], num_samples=1, generator=generator)
+                for i, generator in enumerate(self.generators)
+            ]
+        )
+
+        sampled_scores = torch.full_like(scores, -float("inf"))
+        sampled_scores.scatter_(1, next_tokens[:, None], 0.0)
+        return sampled_scores  # type: ignore
+
+
+class StructureConstraintLogitsProcessor(LogitsProcessor):
+    """
+    Finite-state constraint of the tag sections of the output.
+
+    The state of each row is the last structure token in the sequence.
+    After a section opening token, only content tokens or the next structure token are allowed.
+    Otherwise only the next structure token is allowed.
+    The next structure tokens are forced when the remaining length is just enough to close the sections.
+    """
+
+    def __init__(
+        self,
+        structure_ids: list[int],  # structure token ids in order
+        content_states: list[bool],  # whether content tokens can follow each structure token
+        content_mask: torch.Tensor,  # (vocab_size,) tokens allowed inside sections
+        # index of the last structure token to generate, or the one of each prompt
+        end_index: int | list[int],
+        max_length: int | None = None,
+    ):
+        assert len(structure_ids) == len(content_states)
+
+        self.structure_ids = torch.tensor(structure_ids)
+        self.content_states = torch.tensor(content_states)
+        self.content_mask = content_mask
+        self.end_indices = torch.tensor(
+            end_index if isinstance(end_index, list) else [end_index]
+        )
+        self.max_length = max_length
+
+        self._state_table: torch.Tensor | None = None
+
+    def _prepare(self, scores: torch.Tensor):
+        vocab_size, device = scores.size(-1), scores.device
+        if self._state_table is not None and self._state_table.device == device:
+            return
+
+        # token id -> index in the structure, or -1
+        state_table = torch.full((vocab_size,), -1, dtype=torch.long)
+        state_table[self.structure_ids] = torch.arange(len(self.structure_ids))
+        content_mask = torch.zeros(vocab_size, dtype=torch.bool)
+        num_tokens = min(vocab_size, self.content_mask.size(0))
+        content_mask[:num_tokens] = self.content_mask[:num_tokens].cpu()
+        content_mask[self.structure_ids] = False
+
+        self._state_table = state_table.to(device)
+        self.content_mask = content_mask.to(device)
+        self.structure_ids = self.structure_ids.to(device)
+        self.content_states = self.content_states.to(device)
+        self.end_indices = self.end_indices.to(device)
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        self._prepare(scores)
+        assert self._state_table is not None
+        batch_size, seq_len = input_ids.shape
+
+        # find the last structure token of each row
+        token_states = self._state_table[input_ids]  # (batch_size, seq_len)
+        positions = torch.arange(seq_len, device=input_ids.device).expand(
+            batch_size, seq_len
+        )
+        last_positions = torch.where(token_states >= 0, positions, -1).max(dim=1).values
+        states = torch.where(
+            last_positions >= 0,
+            token_states.gather(1, last_positions.clamp(min=0)[:, None]).squeeze(1),
+            -1,
+        )
+
+        end_indices = self.end_indices
+        if end_indices.size(0) != batch_size:
+            # the beams or the return sequences of each prompt
+            num_repeats = batch_size // end_indices.size(0)
+            end_indices = end_indices.repeat_interleave(num_repeats)
+
+        constrained = (states >= 0) & (states < end_indices)
+        if not constrained.any():
+            return scores
+
+        safe_states = torch.minimum(states.clamp(min=0), end_indices - 1)
+        next_structure_ids = self.structure_ids[safe_states + 1]
+        allow_content = self.content_states[safe_states]
+        if self.max_length is not None:
+            # leave room for closing all the remaining sections
+            num_remaining = self.max_length - seq_len
+            num_required = end_indices - safe_states
+            allow_content = allow_content & (num_remaining > num_required)
+
+        allowed = self.content_mask[None, :] & allow_content[:, None]
+        allowed[torch.arange(batch_size), next_structure_ids] = True
+        allowed |= ~constrained[:, None]
+
+        return scores.masked_fill(~allowed, -float("inf"))  # type: ignore
+
+
+class DuplicateTagsLogitsProcessor(LogitsProcessor):
+    """
+    Masks out the tag tokens that already appear in the sequence
+    """
+
+    def __init__(self, tag_mask: torch.Tensor):
+        self.tag_mask = tag_mask  # (vocab_size,) tokens regarded as tags
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        vocab_size = scores.size(-1)
+        if self.tag_mask.size(0) != vocab_size or self.tag_mask.device != scores.device:
+            tag_mask = torch.zeros(vocab_size, dtype=torch.bool, device=scores.device)
+            num_tokens = min(vocab_size, self.tag_mask.size(0))
+            tag_mask[:num_tokens] = self.tag_mask[:num_tokens]
+            self.tag_mask = tag_mask
+
+        seen = torch.zeros_like(scores, dtype=torch.bool)
+        seen.scatter_(1, input_ids, True)
+
+        return scores.masked_fill(seen & self.tag_mask, -float("inf"))  # type: ignore
@@ -0,0 +1,41 @@
+"""
+Lightweight definitions used to register the nodes.
+This module must not import torch, transformers or comfy, so that ComfyUI starts fast.
+"""
+
+from abc import ABC
+from dataclasses import dataclass
+from typing import Literal, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from transformers import GenerationConfig
+
+MODEL_VERSIONS = Literal["v2408"]
+MODEL_BACKENDS = Literal["torch", "onnx"]
+
+# danbot specific options stored in GenerationConfig
+GENERATION_OPTIONS = ["constrain_structure", "suppress_duplicate_tags"]
+
+PRECISION_TYPE = Literal["fp32", "bf16", "fp16", "int8"]
+PRECISION_TYPES = ["fp32", "bf16", "fp16", "int8"]
+
+
+@dataclass
+class AbstractTemplateConfig(ABC):
+    pass
+
+
+def get_generation_options(generation_config: "GenerationConfig") -> dict[str, bool]:
+    """
+    Returns the danbot specific options of the generation config
+    """
+    return {
+        name: getattr(generation_config, name, False) for name in GENERATION_OPTIONS
+    }
+
+
+def split_tokens(text: str, separator: str = ",") -> list[str]:
+    """
+    Split text into tokens without prefix and suffix spaces
+    """
+    return [token.strip() for token in text.split(separator) if token.strip()]
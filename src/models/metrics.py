@@ -0,0 +1,153 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, asdict
+from typing import Any, Callable, Iterator, TypeVar
+import functools
+import logging
+import os
+import time
+
+
+@dataclass
+class GenerationMetrics:
+    """
+    Timing and token counts of one generation call
+    """
+
+    # wall time of each phase in seconds, e.g. tokenize, encode, ban_tags, prefill, decode
+    phases: dict[str, float] = field(default_factory=dict)
+    total_time: float = 0.0
+    start_time_ns: int = 0
+
+    num_rows: int = 0
+    input_tokens: int = 0  # encoder and decoder template tokens
+    output_tokens: int = 0  # generated tokens
+    result_cache_hits: int = 0
+    prefix_cache_hits: int = 0
+    stop_strings: list[str | None] = field(default_factory=list)  # per row
+
+    @property
+    def tokens_per_second(self) -> float | None:
+        decode_time = self.phases.get("decode", 0.0)
+        if decode_time == 0.0:
+            return None
+        return self.output_tokens / decode_time
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            **asdict(self),
+            "tokens_per_second": self.tokens_per_second,
+        }
+
+
+MetricsHook = Callable[[GenerationMetrics], None]
+
+_current_metrics: ContextVar[GenerationMetrics | None] = ContextVar(
+    "danbot_generation_metrics", default=None
+)
+_hooks: list[MetricsHook] = []
+
+
+def add_metrics_hook(hook: MetricsHook):
+    """
+    Register a function called with the metrics of every finished generation
+    """
+    _hooks.append(hook)
+
+
+def remove_metrics_hook(hook: MetricsHook):
+    _hooks.remove(hook)
+
+
+def current_metrics() -> GenerationMetrics | None:
+    return _current_metrics.get()
+
+
+@contextmanager
+def collect_metrics() -> Iterator[GenerationMetrics]:
+    """
+    Collect the metrics of the generation calls inside the block.
+    Nested blocks add to the outermost record, which is passed to the hooks at the end.
+    """
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        yield metrics
+        return
+
+    metrics = GenerationMetrics(start_time_ns=time.time_ns())
+    token = _current_metrics.set(metrics)
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.total_time = time.perf_counter() - start
+        _current_metrics.reset(token)
+
+        logging.debug(f"Danbot generation metrics: {metrics.to_dict()}")
+        for hook in _hooks:
+            try:
+                hook(metrics)
+            except Exception as e:
+                logging.warning(f"Danbot metrics hook failed: {e}")
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def track_metrics(fn: F) -> F:
+    """
+    Decorator to collect the metrics of the generation method
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with collect_metrics():
+            return fn(*args, **kwargs)
+
+    return wrapper  # type: ignore
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """
+    Add the wall time of the block to the phase of the current metrics, if any
+    """
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        import torch
+
+        if torch.cuda.is_available():
+            # wait for the kernels launched in this phase
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+        metrics.phases[name] = metrics.phases.get(name, 0.0) + elapsed
+
+
+def opentelemetry_hook(metrics: GenerationMetrics):
+    """
+    Export the metrics as an OpenTelemetry span named "danbot.generate"
+    """
+    from opentelemetry import trace
+
+    tracer = trace.get_tracer("danbot-comfy-node")
+    span = tracer.start_span("danbot.generate", start_time=metrics.start_time_ns)
+    for name, seconds in metrics.phases.items():
+        span.set_attribute(f"danbot.phase.{name}_ms", seconds * 1000)
+    span.set_attribute("danbot.num_rows", metrics.num_rows)
+    span.set_attribute("danbot.input_tokens", metrics.input_tokens)
+    span.set_attribute("danbot.output_tokens", metrics.output_tokens)
+    span.set_attribute("danbot.result_cache_hits", metrics.result_cache_hits)
+    span.set_attribute("danbot.prefix_cache_hits", metrics.prefix_cache_hits)
+    span.end(end_time=metrics.start_time_ns + int(metrics.total_time * 1e9))
+
+
+# opt-in export, e.g. with opentelemetry-instrument
+if os.environ.get("DANBOT_OPENTELEMETRY", "0") == "1":
+    add_metrics_hook(opentelemetry_hook)
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from typing import Callable, TYPE_CHECKING
+import logging
+import threading
+
+if TYPE_CHECKING:
+    from .utils import ModelWrapper
+
+# (name, revision, dtype, device, hash of the config entry and its prompt templates)
+ModelKey = tuple[str, str | None, str, str, str]
+
+MAX_LOADED_MODELS = 2
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of loaded models shared by all workflows.
+
+    Models are reference counted by the nodes using them.
+    Unreferenced models are offloaded and evicted in LRU order when the cap is exceeded.
+    While referenced, ComfyUI's model management loads the models before generation
+    and offloads them under memory pressure like the other models.
+    Models of an edited config entry are evicted as soon as they are unreferenced.
+    """
+
+    def __init__(self, max_loaded_models: int = MAX_LOADED_MODELS):
+        self.max_loaded_models = max_loaded_models
+
+        self._models: OrderedDict[ModelKey, "ModelWrapper"] = OrderedDict()
+        self._ref_counts: dict[ModelKey, int] = {}
+        # keys superseded by a model loaded from an edited config entry
+        self._stale_keys: set[ModelKey] = set()
+        self._lock = threading.Lock()
+
+    def acquire(
+        self,
+        key: ModelKey,
+        load_fn: Callable[[], "ModelWrapper"],
+    ) -> "ModelWrapper":
+        """
+        Returns the cached model for the key, or loads it with `load_fn`.
+        Each call must be paired with a `release` call.
+        """
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+            else:
+                logging.info(f"Loading Danbot model: {key}")
+                self._models[key] = load_fn()
+                self._ref_counts[key] = 0
+                # the models of the same entry before it was edited
+                self._stale_keys.update(
+                    other
+                    for other in self._models
+                    if other[:4] == key[:4] and other != key
+                )
+
+            self._ref_counts[key] += 1
+            self._evict()
+
+            return self._models[key]
+
+    def release(self, key: ModelKey):
+        with self._lock:
+            if key not in self._ref_counts:
+                return
+
+            self._ref_counts[key] = max(self._ref_counts[key] - 1, 0)
+            if self._ref_counts[key] == 0:
+                # idle models are kept on the offload device until evicted
+                self._models[key].offload()
+            self._evict()
+
+    def _evict(self):
+        # oldest first
+        idle_keys = [key for key in self._models if self._ref_counts[key] == 0]
+
+        for key in [key for key in idle_keys if key in self._stale_keys]:
+            idle_keys.remove(key)
+            self._unload(key)
+        while len(self._models) > self.max_loaded_models and len(idle_keys) > 0:
+            self._unload(idle_keys.pop(0))
+
+    def _unload(self, key: ModelKey):
+        logging.info(f"Unloading Danbot model: {key}")
+        model = self._models.pop(key)
+        model.offload()
+        del self._ref_counts[key]
+        self._stale_keys.discard(key)
+
+    def clear(self):
+        """
+        Unload all models that are not used by any node
+        """
+        with self._lock:
+            for key in [key for key, count in self._ref_counts.items() if count == 0]:
+                self._models.pop(key).offload()
+                del self._ref_counts[key]
+                self._stale_keys.discard(key)
+
+
+MODEL_REGISTRY = ModelRegistry()
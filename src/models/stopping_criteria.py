@@ -0,0 +1,90 @@
+import torch
+from transformers import StoppingCriteria
+
+# a stop string for all rows, stop strings for all rows, or stop strings per row
+StopTokens = str | list[str] | list[list[str]]
+
+
+def normalize_stop_tokens(stop_tokens: StopTokens, batch_size: int) -> list[list[str]]:
+    """
+    Returns the list of stop strings of each row
+    """
+    if isinstance(stop_tokens, str):
+        return [[stop_tokens]] * batch_size
+    if all(isinstance(stop_token, str) for stop_token in stop_tokens):
+        return [list(stop_tokens)] * batch_size  # type: ignore
+
+    assert len(stop_tokens) == batch_size, (
+        f"Number of stop token lists ({len(stop_tokens)}) and rows ({batch_size}) mismatch."
+    )
+    return [list(row) for row in stop_tokens]  # type: ignore
+
+
+class StopSequencesCriteria(StoppingCriteria):
+    """
+    Stops each row when the generated ids end with one of its stop sequences.
+    Matches token id suffixes without decoding, and records which stop string fired.
+
+    Under beam search, the rows of each prompt are its beams. They are reordered at
+    every step, so the rows are matched again at each step instead of staying stopped.
+    """
+
+    def __init__(
+        self,
+        stop_sequences: dict[str, list[int]],  # stop string -> token ids
+        row_stop_strings: list[list[str]],  # stop strings of each row
+        prompt_length: int,
+        num_beams: int = 1,
+    ):
+        self.stop_strings = [text for text, ids in stop_sequences.items() if ids]
+        self.stop_sequences = [
+            torch.tensor(stop_sequences[text]) for text in self.stop_strings
+        ]
+        # (num_stop_strings, batch_size)
+        self.row_masks = torch.tensor(
+            [
+                [text in stop_strings for stop_strings in row_stop_strings]
+                for text in self.stop_strings
+            ],
+            dtype=torch.bool,
+        ).reshape(len(self.stop_strings), len(row_stop_strings))
+        # (num_stop_strings, batch_size * num_beams)
+        self.row_masks = self.row_masks.repeat_interleave(num_beams, dim=1)
+        self.prompt_length = prompt_length
+        self.num_beams = num_beams
+
+        # index of the fired stop string of each row, or -1
+        self.fired = torch.full((self.row_masks.size(1),), -1, dtype=torch.long)
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        device = input_ids.device
+        assert input_ids.size(0) == self.fired.size(0), (
+            f"Number of rows ({input_ids.size(0)}) and stop string rows ({self.fired.size(0)}) mismatch."
+        )
+        self.fired = self.fired.to(device)
+        if self.num_beams > 1:
+            self.fired = torch.full_like(self.fired, -1)
+        num_generated = input_ids.size(1) - self.prompt_length
+
+        for i, stop_sequence in enumerate(self.stop_sequences):
+            length = len(stop_sequence)
+            if length > num_generated:
+                continue  # must be matched within the generated ids
+            stop_sequence = self.stop_sequences[i] = stop_sequence.to(device)
+
+            matched = (input_ids[:, -length:] == stop_sequence).all(dim=1)
+            matched &= self.row_masks[i].to(device) & (self.fired < 0)
+            self.fired = torch.where(matched, i, self.fired)
+
+        return self.fired >= 0  # type: ignore
+
+    def fired_stop_strings(self) -> list[str | None]:
+        """
+        Returns the stop string that stopped each row
+        """
+        return [
+            self.stop_strings[index] if index >= 0 else None
+            for index in self.fired.tolist()
+        ]
@@ -0,0 +1,76 @@
+from typing import Callable, TYPE_CHECKING
+
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+if TYPE_CHECKING:
+    from .utils import ModelWrapper
+
+# (text, done)
+StreamCallback = Callable[[str, bool], None]
+
+
+class TagStreamer(BaseStreamer):
+    """
+    Streamer that passes the generated tags so far to a callback as each tag is generated.
+    Only the first row is streamed.
+    """
+
+    def __init__(
+        self,
+        model: "ModelWrapper",
+        callback: StreamCallback,
+        prefix: str = "",
+    ):
+        self.model = model
+        self.callback = callback
+        self.prefix = prefix
+
+        self.tags: list[str] = []
+        self._is_prompt = True
+
+    def put(self, value: torch.Tensor):
+        # the first call is the prompt
+        if self._is_prompt:
+            self._is_prompt = False
+            return
+
+        if value.dim() > 1:
+            value = value[0]  # (batch_size, seq_len) -> (seq_len,)
+        else:
+            value = value[:1]  # (batch_size,) -> (1,)
+
+        new_tags = [
+            tag for tag in self.model.decode_tokens(value.tolist()) if tag.strip()
+        ]
+        if len(new_tags) > 0:
+            self.tags.extend(new_tags)
+            self.callback(self.text, False)
+
+    def end(self):
+        self.callback(self.text, True)
+        self._is_prompt = True
+
+    @property
+    def text(self) -> str:
+        return self.model.join_tokens([self.prefix, *self.tags])
+
+
+class RowStreamers(BaseStreamer):
+    """
+    Passes each row of a batch to its own streamer, e.g. of the coalesced requests
+    """
+
+    def __init__(self, streamers: list[BaseStreamer | None]):
+        self.streamers = streamers
+
+    def put(self, value: torch.Tensor):
+        # (batch_size, seq_len) or (batch_size,)
+        for i, streamer in enumerate(self.streamers):
+            if streamer is not None:
+                streamer.put(value[i : i + 1])
+
+    def end(self):
+        for streamer in self.streamers:
+            if streamer is not None:
+                streamer.end()
@@ -0,0 +1,83 @@
+from typing import Callable
+import string
+
+from .cache import LRUCache
+
+# text -> token ids, without special tokens added around
+Tokenize = Callable[[str], list[int]]
+
+# (template name, slot values)
+FormatArgs = tuple[str, tuple[tuple[str, str], ...]]
+
+
+class CachedTokenizer:
+    """
+    Memoizes the token ids of texts with LRU eviction
+    """
+
+    def __init__(self, tokenize: Tokenize, max_size: int):
+        self.tokenize = tokenize
+        self._cache: LRUCache[str, tuple[int, ...]] = LRUCache(max_size=max_size)
+
+    def __call__(self, text: str) -> list[int]:
+        ids = self._cache.get(text)
+        if ids is None:
+            ids = tuple(self.tokenize(text))
+            self._cache.put(text, ids)
+        return list(ids)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class TokenTemplate:
+    """
+    Prompt template split into pre-tokenized fixed fragments and slots.
+    Only the slot values are tokenized when the template is formatted.
+    """
+
+    def __init__(self, template: str, tokenize: Tokenize):
+        # token ids of a fixed fragment, or the name of a slot
+        self.parts: list[list[int] | str] = []
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(
+            template
+        ):
+            if literal:
+                self.parts.append(tokenize(literal))
+            if field_name is not None:
+                assert not format_spec and not conversion, (
+                    f'Unsupported format of slot "{field_name}" in the template.'
+                )
+                self.parts.append(field_name)
+
+    @property
+    def slot_names(self) -> list[str]:
+        return [part for part in self.parts if isinstance(part, str)]
+
+    def format_ids(self, tokenize: Tokenize, format_kwargs: dict[str, str]) -> list[int]:
+        ids = []
+        for part in self.parts:
+            if isinstance(part, str):
+                ids.extend(tokenize(format_kwargs[part]))
+            else:
+                ids.extend(part)
+        return ids
+
+
+def compile_token_template(
+    template: str,
+    tokenize: Tokenize,
+    sample_value: str = " 1girl, solo ",
+) -> TokenTemplate | None:
+    """
+    Pre-tokenize the template. Returns None if splicing the token ids of the fragments
+    gives other ids than tokenizing the formatted text, i.e. a slot is not bounded by
+    special tokens and the tokenizer merges the slot value with its neighbours.
+    """
+    token_template = TokenTemplate(template, tokenize)
+
+    sample_kwargs = {name: sample_value for name in token_template.slot_names}
+    expected = tokenize(template.format(**sample_kwargs))
+    if token_template.format_ids(tokenize, sample_kwargs) != expected:
+        return None
+    return token_template
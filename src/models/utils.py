@@ -1,24 +1,56 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Literal
 from enum import Enum
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+import copy
 import logging
 import re
+import threading
 
 import torch
 from transformers import (
     GenerationConfig,
+    LogitsProcessorList,
+    PreTrainedModel,
     PreTrainedTokenizerFast,
     ProcessorMixin,
 )
+from transformers.generation.streamers import BaseStreamer
+from transformers.utils import cached_file, extract_commit_hash
+
+from ..tags import estimate_rating, RATING_TYPE, load_tags, normalize_tag_text
+from .vocab import VocabIndex
+from .ban_mask import BanMask, load_ban_template_mask, vocab_hash
+from .device import (
+    get_offload_device,
+    get_torch_device,
+    is_comfy_available,
+    soft_empty_cache,
+)
+from .cache import LRUCache, ResultCache, GenerationResult
+from .stopping_criteria import normalize_stop_tokens
+from .logits_processors import build_logits_warpers, PerRowSamplingLogitsProcessor
+from .metrics import current_metrics, track_metrics
+from .metadata import (
+    MODEL_VERSIONS,
+    GENERATION_OPTIONS,
+    PRECISION_TYPE,
+    PRECISION_TYPES,
+    AbstractTemplateConfig,
+    get_generation_options,
+    split_tokens,
+)
 
-from comfy.sd1_clip import escape_important, token_weights, unescape_important
-from comfy.model_management import get_torch_device_name, get_torch_device
-
-from ..tags import estimate_rating, RATING_TYPE, load_tags
+if TYPE_CHECKING:
+    from comfy.model_patcher import ModelPatcher
 
-MODEL_VERSIONS = Literal["v2408"]
+PRECISION_TO_DTYPE: dict[PRECISION_TYPE, torch.dtype] = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+    "int8": torch.float32,  # non-linear layers stay in fp32
+}
 
 
 @dataclass
@@ -31,9 +63,86 @@ class EncoderDecoderTokenizer(ProcessorMixin, ABC):
     decoder_tokenizer: PreTrainedTokenizerFast
 
 
-@dataclass
-class AbstractTemplateConfig(ABC):
-    pass
+# text prompts -> (encoder_hidden_states, encoder_attention_mask)
+EncodeFn = Callable[[tuple[str, ...]], tuple[torch.Tensor, torch.Tensor]]
+
+
+class EncodedPrompt:
+    """
+    Encoder outputs of a text prompt. Can be reused for multiple decoder templates.
+    The encoder runs on the first access of the outputs,
+    so that it is skipped when all results are cached.
+    """
+
+    def __init__(
+        self,
+        text_prompts: tuple[str, ...],
+        encode_fn: EncodeFn | None = None,
+        encoder_hidden_states: torch.Tensor | None = None,
+        encoder_attention_mask: torch.Tensor | None = None,
+    ):
+        assert encode_fn is not None or encoder_hidden_states is not None
+        self.text_prompts = text_prompts
+
+        self._encode_fn = encode_fn
+        self._encoder_hidden_states = encoder_hidden_states
+        self._encoder_attention_mask = encoder_attention_mask
+        self._lock = threading.Lock()
+
+    def _encode(self):
+        with self._lock:
+            if self._encoder_hidden_states is None:
+                assert self._encode_fn is not None
+                self._encoder_hidden_states, self._encoder_attention_mask = (
+                    self._encode_fn(self.text_prompts)
+                )
+
+    @property
+    def is_encoded(self) -> bool:
+        return self._encoder_hidden_states is not None
+
+    @property
+    def encoder_hidden_states(self) -> torch.Tensor:
+        # (batch_size, seq_len, hidden_size)
+        self._encode()
+        return self._encoder_hidden_states  # type: ignore
+
+    @property
+    def encoder_attention_mask(self) -> torch.Tensor:
+        # (batch_size, seq_len)
+        self._encode()
+        return self._encoder_attention_mask  # type: ignore
+
+    def select(self, indices: list[int]) -> "EncodedPrompt":
+        """
+        Returns the encoded prompts of the given batch indices.
+        A single encoded prompt is shared by all indices.
+        """
+        if len(self.text_prompts) == 1:
+            return self
+
+        text_prompts = tuple(self.text_prompts[i] for i in indices)
+        if not self.is_encoded:
+            # only the selected prompts are encoded
+            return EncodedPrompt(text_prompts, encode_fn=self._encode_fn)
+
+        return EncodedPrompt(
+            text_prompts,
+            encoder_hidden_states=self.encoder_hidden_states[indices],
+            encoder_attention_mask=self.encoder_attention_mask[indices],
+        )
+
+
+class PatcherModule(torch.nn.Module):
+    """
+    Container of a transformers model for ComfyUI's ModelPatcher,
+    which assigns `device` to the model. It is a read-only property of PreTrainedModel.
+    """
+
+    def __init__(self, model: PreTrainedModel):
+        super().__init__()
+        self.model = model
+        self.device = model.device
 
 
 class ModelWrapper(ABC):
@@ -42,29 +151,310 @@ class ModelWrapper(ABC):
     """
 
     version: MODEL_VERSIONS
+    precision: PRECISION_TYPE
+    model_id: str  # identifies the model weights
+
+    result_cache: ResultCache | None
 
+    model: PreTrainedModel
     processor: EncoderDecoderTokenizer
 
     prompt_templates: dict[str, str]
     prompt_templates_default: dict[str, dict[str, str]]
 
+    _vocab_index: VocabIndex | None
+    _vocab_hash: str | None
+    _ban_tags_cache: LRUCache[str, BanMask]  # ban tags text -> mask
+    _ban_mask_tensors: LRUCache[tuple[str, str], torch.Tensor]  # (digest, device)
+
+    # registers the model to ComfyUI's model management, created on the first load
+    _patcher: "ModelPatcher | None" = None
+
     @abstractmethod
     def __init__(self, **kwargs):
         raise NotImplementedError
 
+    @property
+    def dtype(self) -> torch.dtype:
+        return PRECISION_TO_DTYPE[self.precision]
+
     def _get_device(self) -> torch.device:
+        if self.precision == "int8":
+            # dynamic quantized kernels are only available on CPU
+            return torch.device("cpu")
         return get_torch_device()
 
+    def _get_offload_device(self) -> torch.device:
+        return get_offload_device()
+
+    def _uses_patcher(self) -> bool:
+        # ComfyUI can not measure the size of dynamically quantized layers,
+        # and int8 models stay on CPU anyway
+        return is_comfy_available() and self.precision != "int8"
+
+    def get_patcher(self) -> "ModelPatcher":
+        from comfy.model_patcher import ModelPatcher
+
+        if self._patcher is None:
+            self._patcher = ModelPatcher(
+                PatcherModule(self.model),
+                load_device=self._get_device(),
+                offload_device=self._get_offload_device(),
+            )
+        return self._patcher
+
+    def load_to_device(self):
+        """
+        Load the model to the inference device through ComfyUI's model management,
+        which may offload other models to make room, and offloads this model
+        under memory pressure in the same way as the other models.
+        Outside of ComfyUI, and for int8 models, the model is just moved to the device.
+        """
+        if not self._uses_patcher():
+            self.model.to(self._get_device())  # type: ignore
+            return
+
+        from comfy import model_management
+
+        # the layers of transformers models can not be loaded partially in lowvram mode
+        model_management.load_models_gpu([self.get_patcher()], force_full_load=True)
+
+    def offload(self):
+        """
+        Move the model to the offload device to free the inference device memory
+        """
+        if not self._uses_patcher():
+            self.model.to(self._get_offload_device())  # type: ignore
+            soft_empty_cache()
+            return
+        if self._patcher is None:
+            return
+
+        from comfy import model_management
+
+        loaded_models = model_management.current_loaded_models
+        for i, loaded_model in enumerate(loaded_models):
+            if loaded_model.model is self._patcher:
+                loaded_models.pop(i).model_unload()
+                soft_empty_cache()
+                break
+
     @abstractmethod
+    def encode(self, text_prompt: str | list[str]) -> EncodedPrompt:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _generate_batch_from_encoded(
+        self,
+        encoded_prompt: EncodedPrompt,
+        tag_templates: list[str],
+        generation_config: GenerationConfig,
+        **kwargs,
+    ) -> list[GenerationResult]:
+        raise NotImplementedError
+
+    def _result_cache_key(
+        self,
+        text_prompt: str,
+        tag_template: str,
+        generation_config: GenerationConfig,
+        streamer: BaseStreamer | None = None,  # does not affect the result
+        **kwargs,
+    ) -> str | None:
+        # only greedy decoding is deterministic
+        if self.result_cache is None or generation_config.do_sample:
+            return None
+
+        return ResultCache.make_key(
+            model=self.model_id,
+            precision=self.precision,
+            text_prompt=text_prompt,
+            tag_template=tag_template,
+            max_new_tokens=generation_config.max_new_tokens,
+            num_beams=generation_config.num_beams,
+            **get_generation_options(generation_config),
+            **kwargs,  # ban_tags, stop_token, etc.
+        )
+
+    @track_metrics
+    def generate_batch_from_encoded(
+        self,
+        encoded_prompt: EncodedPrompt,
+        tag_templates: list[str],
+        generation_config: GenerationConfig,
+        **kwargs,
+    ) -> list[GenerationResult]:
+        text_prompts = encoded_prompt.text_prompts
+        if len(text_prompts) == 1:
+            text_prompts = text_prompts * len(tag_templates)
+
+        # the stop strings of each row, so that each row is cached with its own ones
+        stop_token = kwargs.pop("stop_token", None)
+        row_stop_tokens = (
+            normalize_stop_tokens(stop_token, len(tag_templates))
+            if stop_token is not None
+            else [None] * len(tag_templates)
+        )
+
+        cache_keys = [
+            self._result_cache_key(
+                text_prompt,
+                tag_template,
+                generation_config,
+                stop_token=row_stop_token,
+                **kwargs,
+            )
+            for text_prompt, tag_template, row_stop_token in zip(
+                text_prompts, tag_templates, row_stop_tokens
+            )
+        ]
+        results = [
+            self.result_cache.get(key)
+            if (self.result_cache is not None and key is not None)
+            else None
+            for key in cache_keys
+        ]
+
+        missing_indices = [i for i, result in enumerate(results) if result is None]
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.num_rows += len(results)
+            metrics.result_cache_hits += len(results) - len(missing_indices)
+        if len(missing_indices) == 0:
+            return results  # type: ignore
+
+        if len(missing_indices) < len(results):
+            encoded_prompt = encoded_prompt.select(missing_indices)
+        generated = self._generate_batch_from_encoded(
+            encoded_prompt,
+            tag_templates=[tag_templates[i] for i in missing_indices],
+            generation_config=generation_config,
+            stop_token=(
+                [row_stop_tokens[i] for i in missing_indices]  # type: ignore
+                if stop_token is not None
+                else None
+            ),
+            **kwargs,
+        )
+        for i, result in zip(missing_indices, generated):
+            results[i] = result
+            key = cache_keys[i]
+            if self.result_cache is not None and key is not None:
+                self.result_cache.put(key, result)
+
+        return results  # type: ignore
+
+    @track_metrics
+    def generate_from_encoded(
+        self,
+        encoded_prompt: EncodedPrompt,
+        tag_template: str,
+        generation_config: GenerationConfig,
+        **kwargs,
+    ) -> GenerationResult:
+        return self.generate_batch_from_encoded(
+            encoded_prompt,
+            tag_templates=[tag_template],
+            generation_config=generation_config,
+            **kwargs,
+        )[0]
+
+    @track_metrics
     def generate(
         self,
         text_prompt: str,
         tag_template: str,
         generation_config: GenerationConfig,
         **kwargs,
-    ) -> tuple[str, str, str]:
+    ) -> GenerationResult:
+        return self.generate_batch(
+            text_prompts=[text_prompt],
+            tag_templates=[tag_template],
+            generation_config=generation_config,
+            **kwargs,
+        )[0]
+
+    @track_metrics
+    def generate_batch(
+        self,
+        text_prompts: list[str],
+        tag_templates: list[str],
+        generation_config: GenerationConfig,
+        **kwargs,
+    ) -> list[GenerationResult]:
+        """
+        Generate tags for multiple prompts at once.
+        Returns a list of (full, completion, raw) tuples in the same order as the prompts.
+        """
+        if len(text_prompts) == 0:
+            return []
+        if len(tag_templates) == 1:
+            tag_templates = tag_templates * len(text_prompts)
+        assert len(text_prompts) == len(tag_templates), (
+            f"Number of prompts ({len(text_prompts)}) and templates ({len(tag_templates)}) mismatch."
+        )
+
+        # the encoder runs only if some results are not cached
+        encoded_prompt = self.encode(text_prompts)
+
+        return self.generate_batch_from_encoded(
+            encoded_prompt,
+            tag_templates=tag_templates,
+            generation_config=generation_config,
+            **kwargs,
+        )
+
+    @track_metrics
+    def generate_variants(
+        self,
+        text_prompt: str,
+        tag_template: str,
+        generation_config: GenerationConfig,
+        seed: int,
+        num_variants: int,
+        **kwargs,
+    ) -> list[GenerationResult]:
+        """
+        Generate multiple variants of the same prompt in one batch.
+        The i-th variant is sampled with `seed + i`, so it does not depend on `num_variants`.
+        """
+        encoded_prompt = self.encode(text_prompt)
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.num_rows += num_variants
+
+        # sampling is done by the per-row processor, and the greedy search picks its token
+        sampling_config = copy.deepcopy(generation_config)
+        sampling_config.do_sample = True
+        sampler = PerRowSamplingLogitsProcessor(
+            seeds=[(seed + i) % 2**32 for i in range(num_variants)],
+            logits_warper=build_logits_warpers(sampling_config),
+        )
+
+        return self._generate_batch_from_encoded(
+            encoded_prompt,
+            tag_templates=[tag_template] * num_variants,
+            generation_config=GenerationConfig(
+                do_sample=False,
+                num_beams=1,
+                max_new_tokens=generation_config.max_new_tokens,
+                **get_generation_options(generation_config),
+            ),
+            logits_processor=LogitsProcessorList([sampler]),
+            **kwargs,
+        )
+
+    @abstractmethod
+    def decode_tokens(
+        self,
+        token_ids: list[int],
+        skip_special_tokens: bool = True,
+    ) -> list[str]:
         raise NotImplementedError
 
+    def join_tokens(self, tokens: list[str]) -> str:
+        return ", ".join([token for token in tokens if token.strip() != ""])
+
     @abstractmethod
     def format_prompt(self, template_name: str, format_kwargs: dict[str, str]) -> str:
         raise NotImplementedError
@@ -78,27 +468,75 @@ class ModelWrapper(ABC):
             rating=rating,
         )
 
-    def encode_ban_tags(self, ban_tags: str) -> list[list[int]] | None:
+    def get_vocab_index(self) -> VocabIndex:
+        """
+        Returns the decoder vocab index. Built once per loaded model.
+        """
+        if self._vocab_index is None:
+            self._vocab_index = VocabIndex(
+                self.processor.decoder_tokenizer.get_vocab()
+            )
+        return self._vocab_index
+
+    def get_vocab_hash(self) -> str:
+        if self._vocab_hash is None:
+            self._vocab_hash = vocab_hash(self.processor.decoder_tokenizer.get_vocab())
+        return self._vocab_hash
+
+    def encode_ban_tags(self, ban_tags: str) -> list[int]:
         # wildcard tags support
         tags = [tag.strip() for tag in ban_tags.split(",")]
-        vocab = self.processor.decoder_tokenizer.get_vocab()
+        vocab_index = self.get_vocab_index()
 
-        ban_token_ids: list[list[int]] = []
+        ban_token_ids: list[int] = []
         for tag in tags:  # search tags in vocab
-            if "*" in tag:
-                pattern = re.compile(tag.replace("*", ".*"))
-                for token, _id in vocab.items():
-                    if pattern.match(token):
-                        ban_token_ids.append([_id])
-            else:
-                if tag in vocab:
-                    ban_token_ids.append([vocab[tag]])
-
-        if len(ban_token_ids) == 0:
-            return None
+            if tag:
+                ban_token_ids.extend(vocab_index.search(tag))
 
         return ban_token_ids
 
+    def compile_ban_tags(self, ban_tags: str) -> BanMask:
+        """
+        Compile comma separated ban tags, including wildcards, into a ban mask.
+        The result is cached per ban tags text.
+        """
+        ban_mask = self._ban_tags_cache.get(ban_tags)
+        if ban_mask is None:
+            ban_mask = BanMask.from_token_ids(
+                self.encode_ban_tags(ban_tags),
+                vocab_size=len(self.processor.decoder_tokenizer),
+                vocab_hash=self.get_vocab_hash(),
+            )
+            self._ban_tags_cache.put(ban_tags, ban_mask)
+        return ban_mask
+
+    def get_ban_mask_tensor(self, ban_mask: BanMask) -> torch.Tensor:
+        """
+        Returns the boolean mask of shape (vocab_size,) on the model device.
+        The result is cached per mask content and device.
+        """
+        key = (ban_mask.digest, str(self.device))
+        tensor = self._ban_mask_tensors.get(key)
+        if tensor is None:
+            tensor = ban_mask.to_tensor().to(self.device)
+            self._ban_mask_tensors.put(key, tensor)
+        return tensor
+
+    def compile_ban_template(self, path: str | Path) -> BanMask:
+        """
+        Compile a ban template file into a ban mask of the decoder vocab.
+        The tags are normalized like the ban tags of LoadBanTagsNode.
+        The mask is saved next to the template and memory-mapped on later loads.
+        """
+        return load_ban_template_mask(
+            path,
+            vocab_size=len(self.processor.decoder_tokenizer),
+            vocab_hash=self.get_vocab_hash(),
+            encode_tags=lambda tags: self.encode_ban_tags(
+                normalize_tag_text(",".join(tags))
+            ),
+        )
+
     def search_tags(self, text: str, pattern: re.Pattern) -> str:
         result = pattern.search(text)
         if result is None:
@@ -119,6 +557,8 @@ def unescape_important_all(text: str) -> list[str]:
     """
     Remove all emphasis brackets and returns a list of tokens
     """
+    from comfy.sd1_clip import escape_important, token_weights, unescape_important
+
     text = escape_important(text)
     parsed_weights: list[tuple[str, float]] = token_weights(text, 1.0)
     unescaped_tokens = []
@@ -133,11 +573,33 @@ def unescape_important_all(text: str) -> list[str]:
     return unescaped_tokens
 
 
-def split_tokens(text: str, separator: str = ",") -> list[str]:
+def resolve_commit_hash(model_name_or_path: str, revision: str | None) -> str | None:
+    """
+    Returns the commit hash of a Hugging Face Hub checkpoint, or None for local paths
+    """
+    try:
+        resolved_file = cached_file(
+            model_name_or_path,
+            "config.json",
+            revision=revision,
+            _raise_exceptions_for_missing_entries=False,
+            _raise_exceptions_for_connection_errors=False,
+        )
+    except Exception:
+        return None
+    return extract_commit_hash(resolved_file, None)
+
+
+def quantize_dynamic_int8(model: PreTrainedModel) -> PreTrainedModel:
     """
-    Split text into tokens without prefix and suffix spaces
+    Quantize the linear layers of the model to int8 with dynamic activation scales
     """
-    return [token.strip() for token in text.split(separator) if token.strip()]
+    return torch.ao.quantization.quantize_dynamic(
+        model,
+        {torch.nn.Linear},
+        dtype=torch.qint8,
+        inplace=True,
+    )
 
 
 def is_flash_attn_available():
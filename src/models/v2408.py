@@ -1,7 +1,7 @@
-from dataclasses import dataclass
-from typing import Any, Literal
+from typing import Any
 from abc import ABC
-import math
+import copy
+import logging
 import re
 
 import torch
@@ -9,85 +9,101 @@ import torch
 from transformers import (
     AutoModelForPreTraining,
     AutoProcessor,
+    CompileConfig,
     GenerationConfig,
     PreTrainedModel,
-    BatchFeature,
+    BatchEncoding,
+    LogitsProcessorList,
+    StoppingCriteriaList,
 )
+from transformers.generation.streamers import BaseStreamer
 
 from .utils import (
     ModelWrapper,
+    BanMask,
     EncoderDecoderTokenizer,
-    AbstractTemplateConfig,
+    EncodedPrompt,
+    PRECISION_TYPE,
     is_flash_attn_available,
+    quantize_dynamic_int8,
+)
+from .logits_processors import (
+    BanTokensLogitsProcessor,
+    StructureConstraintLogitsProcessor,
+    DuplicateTagsLogitsProcessor,
+)
+from .cache import LRUCache, ResultCache, GenerationResult
+from .template import (
+    CachedTokenizer,
+    FormatArgs,
+    TokenTemplate,
+    compile_token_template,
+)
+from .metrics import current_metrics, phase
+from .v2408_metadata import (
+    RATING_MAP,
+    LENGTH_MAP,
+    ASPECT_RATIO_MAP,
+    INPUT_END,
+    TRANSLATION_END,
+    EXTENSION_END,
+    TRANSLATION_STOP_TOKENS,
+    EXTENSION_STOP_TOKENS,
+    OUTPUT_STRUCTURE,
+    TEMPLATE_NAME,
+    TEMPLATE_NAMES,
+    TemplateConfig,
+    aspect_ratio_tag,
+)
+from .stopping_criteria import (
+    StopTokens,
+    StopSequencesCriteria,
+    normalize_stop_tokens,
 )
-
-RATING_MAP = {
-    "general": "<|rating:general|>",
-    "sensitive": "<|rating:sensitive|>",
-    "questionable": "<|rating:questionable|>",
-    "explicit": "<|rating:explicit|>",
-}
-
-LENGTH_MAP = {
-    "very_short": "<|length:very_short|>",
-    "short": "<|length:short|>",
-    "long": "<|length:long|>",
-    "very_long": "<|length:very_long|>",
-}
-
-ASPECT_RATIO_MAP = {
-    "too_tall": "<|aspect_ratio:too_tall|>",
-    "tall_wallpaper": "<|aspect_ratio:tall_wallpaper|>",
-    "tall": "<|aspect_ratio:tall|>",
-    "square": "<|aspect_ratio:square|>",
-    "wide": "<|aspect_ratio:wide|>",
-    "wide_wallpaper": "<|aspect_ratio:wide_wallpaper|>",
-    "too_wide": "<|aspect_ratio:too_wide|>",
-}
-
-INPUT_END = "<|input_end|>"
-TRANSLATION_END = "<|reserved_6|>"
-EXTENSION_END = "</general>"
 
 COPYRIGHT_TAGS_PATTERN = re.compile(r"<copyright>(.*?)</copyright>")
 CHARACTER_TAGS_PATTERN = re.compile(r"<character>(.*?)</character>")
 TRANSLATION_TAGS_PATTERN = re.compile(r"<translation>(.*?)</translation>")
 EXTENSION_TAGS_PATTERN = re.compile(r"<extension>(.*?)</extension>")
 
-TEMPLATE_NAME = Literal["translation", "extension"]
-TEMPLATE_NAMES = ["translation", "extension"]
+# (text_prompt, decoder prefix ids)
+PrefixCacheKey = tuple[str, tuple[int, ...]]
+PREFIX_CACHE_SIZE = 64
+RESULT_CACHE_SIZE = 1024
+TOKENIZE_CACHE_SIZE = 4096
+FORMATTED_TEMPLATE_CACHE_SIZE = 1024
+BAN_MASK_CACHE_SIZE = 64
+
+# upper bound of max_new_tokens in GenerationConfigNode
+COMPILE_MAX_NEW_TOKENS = 512
 
 
-def aspect_ratio_tag(
-    width: int,
-    height: int,
-) -> str:
+def pad_token_ids(
+    input_ids: list[list[int]],
+    pad_token_id: int,
+    padding_side: str = "right",
+) -> BatchEncoding:
     """
-    Returns aspect ratio tag based on the aspect ratio of the image.
+    Pad the token ids of the texts tokenized one by one into a batch
     """
-    ar = math.log2(width / height)
-
-    if ar <= -1.25:
-        return "too_tall"
-    elif ar <= -0.75:
-        return "tall_wallpaper"
-    elif ar <= -0.25:
-        return "tall"
-    elif ar < 0.25:
-        return "square"
-    elif ar < 0.75:
-        return "wide"
-    elif ar < 1.25:
-        return "wide_wallpaper"
-    else:
-        return "too_wide"
-
-
-@dataclass
-class TemplateConfig(AbstractTemplateConfig):
-    aspect_ratio: str
-    rating: str
-    length: str
+    max_len = max(len(ids) for ids in input_ids)
+    padded_ids, attention_mask = [], []
+    for ids in input_ids:
+        padding = [pad_token_id] * (max_len - len(ids))
+        mask = [1] * len(ids)
+        if padding_side == "left":
+            padded_ids.append(padding + ids)
+            attention_mask.append([0] * len(padding) + mask)
+        else:
+            padded_ids.append(ids + padding)
+            attention_mask.append(mask + [0] * len(padding))
+
+    return BatchEncoding(
+        {
+            "input_ids": torch.tensor(padded_ids, dtype=torch.long),
+            "attention_mask": torch.tensor(attention_mask, dtype=torch.long),
+        }
+    )
 
 
 class V2408Processor(EncoderDecoderTokenizer, ABC):
@@ -109,6 +125,18 @@ class V2408Model(ModelWrapper):
     model: _Model
     processor: V2408Processor
 
+    use_prefix_cache = True
+    supports_beam_search = True
+
+    _token_texts: tuple[list[str], list[str]] | None
+    _tag_mask: torch.Tensor | None
+
+    _encoder_tokenize: CachedTokenizer
+    _decoder_tokenize: CachedTokenizer
+    _token_templates: dict[str, TokenTemplate | None]
+    # formatted text -> how it was formatted by format_prompt
+    _formatted_templates: LRUCache[str, FormatArgs]
+
     prompt_templates: dict[TEMPLATE_NAME, str]
     prompt_templates_default: dict[TEMPLATE_NAME, dict[str, str]] = {
         "translation": {},
@@ -125,20 +153,30 @@ class V2408Model(ModelWrapper):
         prompt_templates: dict[TEMPLATE_NAME, str],
         revision: str | None = None,
         trust_remote_code: bool = False,
+        precision: PRECISION_TYPE = "bf16",
+        torch_compile: bool = False,
+        result_cache_path: str | None = None,
     ):
+        self.precision = precision
         load_device = self._get_device()
 
         self.model = AutoModelForPreTraining.from_pretrained(
             model_name_or_path,
             revision=revision,
-            torch_dtype=torch.bfloat16,
+            torch_dtype=self.dtype,
             trust_remote_code=trust_remote_code,
             attn_implementation=(
                 "flash_attention_2"
-                if (is_flash_attn_available() and load_device.type == "cuda")
+                if (
+                    is_flash_attn_available()
+                    and load_device.type == "cuda"
+                    and precision in ("bf16", "fp16")
+                )
                 else "sdpa"
             ),
         )
+        if precision == "int8":
+            self.model = quantize_dynamic_int8(self.model)
         self.model.to(load_device)  # type: ignore
         self.model.eval()
         self.processor = AutoProcessor.from_pretrained(
@@ -147,69 +185,529 @@ class V2408Model(ModelWrapper):
             trust_remote_code=trust_remote_code,
         )
         self.prompt_templates = prompt_templates
+        # the resolved commit, so that the persisted results of an old checkpoint are not used
+        commit_hash = getattr(self.model.config, "_commit_hash", None)
+        self.model_id = f"{model_name_or_path}@{commit_hash or revision or 'main'}"
+        self.result_cache = ResultCache(
+            max_size=RESULT_CACHE_SIZE,
+            path=result_cache_path,
+        )
+
+        self._vocab_index = None
+        self._vocab_hash = None
+        self._ban_tags_cache = LRUCache(max_size=BAN_MASK_CACHE_SIZE)
+        self._ban_mask_tensors = LRUCache(max_size=BAN_MASK_CACHE_SIZE)
+        self._token_texts = None
+        self._tag_mask = None
+        self._prefix_cache: LRUCache[PrefixCacheKey, Any] = LRUCache(
+            max_size=PREFIX_CACHE_SIZE
+        )
+        self._init_tokenization()
+
+        self.torch_compile = torch_compile
+        if torch_compile:
+            self.compile()
+
+    def _init_tokenization(self):
+        """
+        Set up the tokenization caches and pre-tokenize the prompt templates
+        """
+        self._encoder_tokenize = CachedTokenizer(
+            lambda text: self.processor.encoder_tokenizer(text).input_ids,
+            max_size=TOKENIZE_CACHE_SIZE,
+        )
+        self._decoder_tokenize = CachedTokenizer(
+            lambda text: self.processor.decoder_tokenizer(
+                text, add_special_tokens=False
+            ).input_ids,
+            max_size=TOKENIZE_CACHE_SIZE,
+        )
+        self._token_templates = {}
+        for name, template in self.prompt_templates.items():
+            self._token_templates[name] = compile_token_template(
+                template, self._decoder_tokenize
+            )
+            if self._token_templates[name] is None:
+                logging.info(f'Template "{name}" is tokenized as a whole text.')
+        self._formatted_templates = LRUCache(max_size=FORMATTED_TEMPLATE_CACHE_SIZE)
+
+    def compile(self):
+        """
+        Let transformers compile the decoding step with a static kv cache, and warm it up
+        with a cache large enough for any generation of the generation config node.
+        The prefill runs eagerly, so new prompt and template lengths are not recompiled.
+        """
+        # the static cache can't be seeded with the prefix past key values
+        self.use_prefix_cache = False
+        if not getattr(self.model, "_supports_static_cache", False):
+            logging.warning("The model does not support a static cache. Not compiled.")
+        elif self.device.type != "cuda":
+            logging.warning("The decoding step is compiled only on CUDA devices.")
+
+        warmup_template = self.format_prompt(
+            template_name="translation",
+            format_kwargs={
+                "rating": RATING_MAP["general"],
+                "aspect_ratio": ASPECT_RATIO_MAP["tall"],
+                "length": LENGTH_MAP["very_short"],
+            },
+        )
+        self._generate_batch_from_encoded(
+            self.encode("warmup"),
+            tag_templates=[warmup_template],
+            generation_config=GenerationConfig(
+                do_sample=False,
+                max_new_tokens=COMPILE_MAX_NEW_TOKENS,
+            ),
+        )
+
+    def offload(self):
+        # the cached past key values live on the inference device
+        self._prefix_cache.clear()
+        super().offload()
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
 
     def format_prompt(self, template_name: str, format_kwargs: dict[str, str]) -> str:
         assert template_name in self.prompt_templates, (
             f'Template name "{template_name}" not found.'
         )
-        return self.prompt_templates[template_name].format(**format_kwargs)
+        text = self.prompt_templates[template_name].format(**format_kwargs)
+        if self._token_templates.get(template_name) is not None:
+            # remembered so that tokenize_templates can splice the token ids
+            self._formatted_templates.put(
+                text, (template_name, tuple(format_kwargs.items()))
+            )
+        return text
+
+    def tokenize_templates(self, tag_templates: list[str]) -> BatchEncoding:
+        """
+        Tokenize the formatted decoder templates with left padding.
+        The templates from format_prompt are assembled from the pre-tokenized fragments,
+        so that only the slot values are tokenized.
+        """
+        input_ids = []
+        for text in tag_templates:
+            format_args = self._formatted_templates.get(text)
+            if format_args is None:
+                input_ids.append(self._decoder_tokenize(text))
+                continue
+            template_name, format_kwargs = format_args
+            token_template = self._token_templates[template_name]
+            assert token_template is not None
+            input_ids.append(
+                token_template.format_ids(self._decoder_tokenize, dict(format_kwargs))
+            )
+
+        return pad_token_ids(
+            input_ids,
+            pad_token_id=self.processor.decoder_tokenizer.pad_token_id,  # type: ignore
+            padding_side="left",
+        )
+
+    def encode(self, text_prompt: str | list[str]) -> EncodedPrompt:
+        text_prompts = [text_prompt] if isinstance(text_prompt, str) else text_prompt
+        return EncodedPrompt(tuple(text_prompts), encode_fn=self._encode_texts)
 
     @torch.inference_mode()
-    def generate(
+    def _encode_texts(
+        self, text_prompts: tuple[str, ...]
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        self.load_to_device()
+        with phase("tokenize"):
+            encoder_tokenizer = self.processor.encoder_tokenizer
+            encoder_inputs = pad_token_ids(
+                [self._encoder_tokenize(text) for text in text_prompts],
+                pad_token_id=encoder_tokenizer.pad_token_id,  # type: ignore
+                padding_side=encoder_tokenizer.padding_side,
+            ).to(self.device)
+
+        with phase("encode"):
+            encoder_hidden_states = self._encode_ids(
+                input_ids=encoder_inputs.input_ids,
+                attention_mask=encoder_inputs.attention_mask,
+            )
+
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.input_tokens += int(encoder_inputs.attention_mask.sum())
+
+        return encoder_hidden_states, encoder_inputs.attention_mask
+
+    def _encode_ids(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        return self.model.encoder_model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+        ).last_hidden_state
+
+    def _get_prefix_past_key_values(
         self,
-        text_prompt: str,
-        tag_template: str,
+        encoded_prompt: EncodedPrompt,
+        input_ids: torch.Tensor,  # (batch_size, seq_len)
+        attention_mask: torch.Tensor,
+    ) -> Any | None:
+        """
+        Returns a copy of the past key values of the template header
+        (up to <|input_end|>), computed once per prompt and header.
+        All rows must share the prompt and the header, e.g. the variants of a seed sweep.
+        """
+        batch_size = input_ids.size(0)
+        if len(set(encoded_prompt.text_prompts)) > 1:
+            return None
+
+        input_end_id = self.processor.decoder_tokenizer.convert_tokens_to_ids(
+            INPUT_END
+        )
+        ids: list[int] = input_ids[0].tolist()
+        if input_end_id not in ids:
+            return None
+        prefix_len = ids.index(input_end_id) + 1
+        if prefix_len >= len(ids):
+            return None  # at least one token must be left to prefill
+        if batch_size > 1 and not (
+            bool(attention_mask[:, :prefix_len].all())
+            and bool((input_ids[:, :prefix_len] == input_ids[:1, :prefix_len]).all())
+        ):
+            return None  # the headers differ or are padded
+
+        if len(encoded_prompt.text_prompts) > 1:
+            encoded_prompt = encoded_prompt.select([0])
+        key = (encoded_prompt.text_prompts[0], tuple(ids[:prefix_len]))
+        past_key_values = self._prefix_cache.get(key)
+        metrics = current_metrics()
+        if past_key_values is None:
+            with phase("prefill"):
+                past_key_values = self.model(
+                    input_ids=input_ids[:1, :prefix_len],
+                    attention_mask=torch.ones_like(input_ids[:1, :prefix_len]),
+                    encoder_hidden_states=encoded_prompt.encoder_hidden_states,
+                    encoder_attention_mask=encoded_prompt.encoder_attention_mask,
+                    use_cache=True,
+                ).past_key_values
+            self._prefix_cache.put(key, past_key_values)
+        elif metrics is not None:
+            metrics.prefix_cache_hits += 1
+
+        # generate() extends the cache in place
+        past_key_values = copy.deepcopy(past_key_values)
+        if batch_size > 1:
+            if not hasattr(past_key_values, "batch_repeat_interleave"):
+                return None  # legacy tuple cache
+            past_key_values.batch_repeat_interleave(batch_size)
+        return past_key_values
+
+    @torch.inference_mode()
+    def _generate_batch_from_encoded(
+        self,
+        encoded_prompt: EncodedPrompt,
+        tag_templates: list[str],
         generation_config: GenerationConfig,
         ban_tags: str | None = None,
-        stop_token: str | None = None,
+        ban_mask: BanMask | None = None,
+        stop_token: StopTokens | None = None,
+        logits_processor: LogitsProcessorList | None = None,
+        streamer: BaseStreamer | None = None,
         **kwargs,
-    ) -> tuple[str, str, str]:
-        inputs: BatchFeature = self.processor(
-            encoder_text=text_prompt,
-            decoder_text=tag_template,
-            return_tensors="pt",
-        ).to(self.model.device)
-        input_ids_len = len(inputs.input_ids[0])
-
-        ban_token_ids = None
+    ) -> list[GenerationResult]:
+        self.load_to_device()
+
+        batch_size = len(tag_templates)
+        encoder_hidden_states = encoded_prompt.encoder_hidden_states
+        encoder_attention_mask = encoded_prompt.encoder_attention_mask
+        if encoder_hidden_states.size(0) == 1 and batch_size > 1:
+            # share one encoded prompt with all templates
+            encoder_hidden_states = encoder_hidden_states.expand(batch_size, -1, -1)
+            encoder_attention_mask = encoder_attention_mask.expand(batch_size, -1)
+        assert encoder_hidden_states.size(0) == batch_size, (
+            f"Number of prompts ({encoder_hidden_states.size(0)}) and templates ({batch_size}) mismatch."
+        )
+
+        # the template already contains the special tokens like <|bos|>.
+        # left padding so that all completions start at the same position
+        with phase("tokenize"):
+            inputs = self.tokenize_templates(tag_templates).to(self.device)
+        input_ids_len = inputs.input_ids.size(1)
+        num_pad_tokens = (inputs.attention_mask == 0).sum(dim=1).tolist()
+
+        processors = LogitsProcessorList()
+        if ban_mask is not None:
+            assert ban_mask.vocab_hash == self.get_vocab_hash(), (
+                "The ban mask was compiled for another tokenizer."
+            )
         if ban_tags is not None:
-            ban_token_ids = self.encode_ban_tags(ban_tags)
+            with phase("ban_tags"):
+                ban_tags_mask = self.compile_ban_tags(ban_tags)
+            ban_mask = ban_tags_mask if ban_mask is None else ban_mask | ban_tags_mask
+        if ban_mask is not None and not ban_mask.is_empty():
+            processors.append(
+                BanTokensLogitsProcessor(self.get_ban_mask_tensor(ban_mask))
+            )
+        num_rows = batch_size * generation_config.num_return_sequences
+        prompt_stop_strings = normalize_stop_tokens(stop_token or [], batch_size)
+        row_stop_strings = [
+            stop_strings
+            for stop_strings in prompt_stop_strings
+            for _ in range(generation_config.num_return_sequences)
+        ]
+        if getattr(generation_config, "constrain_structure", False):
+            structure_processor = self._build_structure_processor(
+                prompt_stop_strings=prompt_stop_strings,
+                max_length=input_ids_len + (generation_config.max_new_tokens or 0),
+            )
+            if structure_processor is not None:
+                processors.append(structure_processor)
+        if getattr(generation_config, "suppress_duplicate_tags", False):
+            processors.append(DuplicateTagsLogitsProcessor(self.get_tag_mask()))
+        if logits_processor is not None:
+            processors.extend(logits_processor)
+
+        pad_token_id = self.processor.decoder_tokenizer.pad_token_id
+        eos_token_ids = [self.processor.decoder_tokenizer.eos_token_id]
+        stopping_criteria = StoppingCriteriaList()
+        stop_criteria = None
+        num_beams = generation_config.num_beams if self.supports_beam_search else 1
+        if any(len(stop_strings) > 0 for stop_strings in row_stop_strings):
+            stop_sequences = self.encode_stop_strings(
+                [text for stop_strings in row_stop_strings for text in stop_strings]
+            )
+            if num_beams > 1:
+                # beam search finalizes the beams only at the eos tokens
+                eos_token_ids += self._beam_stop_token_ids(
+                    prompt_stop_strings, stop_sequences
+                )
+            stop_criteria = StopSequencesCriteria(
+                stop_sequences=stop_sequences,
+                # the beams of each prompt share its stop strings
+                row_stop_strings=(
+                    prompt_stop_strings if num_beams > 1 else row_stop_strings
+                ),
+                prompt_length=input_ids_len,
+                num_beams=num_beams,
+            )
+            stopping_criteria.append(stop_criteria)
+
+        output_ids = self._generate_ids(
+            encoded_prompt,
+            input_ids=inputs.input_ids,
+            attention_mask=inputs.attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            generation_config=generation_config,
+            logits_processor=processors,
+            stopping_criteria=stopping_criteria,
+            streamer=streamer,
+            eos_token_id=eos_token_ids,
+            pad_token_id=pad_token_id,
+        )
+        assert output_ids.size(0) == num_rows
+
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.input_tokens += int(inputs.attention_mask.sum())
+        # the rows of the beams are not the output sequences
+        if stop_criteria is not None and num_beams == 1:
+            fired_stop_strings = stop_criteria.fired_stop_strings()
+            logging.debug(f"Stopped by: {fired_stop_strings}")
+            if metrics is not None:
+                metrics.stop_strings.extend(fired_stop_strings)
+
+        output_ids_list: list[list[int]] = output_ids.tolist()
+        outputs = []
+        with phase("detokenize"):
+            for i, num_pad in enumerate(num_pad_tokens):
+                # (batch_size, num_return_sequences) are flattened in the first dim
+                sequence_ids = output_ids_list[i * len(output_ids_list) // batch_size]
+                completion_ids = sequence_ids[input_ids_len:]
+                if pad_token_id is not None:
+                    # remove the trailing paddings of the sequences finished early
+                    while len(completion_ids) > 0 and completion_ids[-1] == pad_token_id:
+                        completion_ids.pop()
+                sequence_ids = sequence_ids[num_pad:input_ids_len] + completion_ids
+                if metrics is not None:
+                    metrics.output_tokens += len(completion_ids)
+
+                outputs.append(
+                    self.decode_outputs(
+                        sequence_ids, completion_start=input_ids_len - num_pad
+                    )
+                )
 
-        stop_token_id = self.processor.decoder_tokenizer.eos_token_id
-        if stop_token is not None:
-            stop_token_id = self.processor.decoder_tokenizer(
-                stop_token, return_tensors="pt"
-            ).input_ids
+        return outputs
 
-        output_ids = self.model.generate(
-            **inputs,
-            generation_config=generation_config,
-            bad_words_ids=ban_token_ids,
-            eos_token_id=stop_token_id,
-            pad_token_id=self.processor.decoder_tokenizer.pad_token_id,
-        )[0]  # take the first sequence
-        output_full = self.decode_ids(output_ids)
-        output_completion = self.decode_ids(output_ids[input_ids_len:])
-        output_raw = self.decode_ids(output_ids, skip_special_tokens=False)
+    def get_tag_mask(self) -> torch.Tensor:
+        """
+        Returns the mask of the tag tokens, i.e. the tokens that are not special
+        """
+        if self._tag_mask is None:
+            texts, _raw_texts = self.get_token_texts()
+            self._tag_mask = torch.tensor([text.strip() != "" for text in texts])
+        return self._tag_mask
+
+    def _beam_stop_token_ids(
+        self,
+        prompt_stop_strings: list[list[str]],
+        stop_sequences: dict[str, list[int]],  # stop string -> token ids
+    ) -> list[int]:
+        """
+        Returns the ids of the single-token stop strings, which end beams as eos tokens.
+        The eos tokens are shared by all rows, so the stop strings of all rows are used.
+        """
+        if any(strings != prompt_stop_strings[0] for strings in prompt_stop_strings):
+            logging.warning("Beam search stops all rows at the stop strings of any row.")
+
+        stop_token_ids = set()
+        for text in {text for strings in prompt_stop_strings for text in strings}:
+            if len(stop_sequences[text]) == 1:
+                stop_token_ids.add(stop_sequences[text][0])
+            elif len(stop_sequences[text]) > 1:
+                logging.warning(
+                    f'Beam search stops at "{text}" only when all beams end with it, '
+                    "because it is not a single token."
+                )
+        return sorted(stop_token_ids)
+
+    def encode_stop_strings(self, stop_strings: list[str]) -> dict[str, list[int]]:
+        """
+        Tokenize the stop strings into token id sequences
+        """
+        tokenizer = self.processor.decoder_tokenizer
+        return {
+            text: tokenizer(text, add_special_tokens=False).input_ids
+            for text in set(stop_strings)
+        }
 
-        return (output_full, output_completion, output_raw)
+    def _build_structure_processor(
+        self,
+        prompt_stop_strings: list[list[str]],  # stop strings of each prompt
+        max_length: int | None,
+    ) -> StructureConstraintLogitsProcessor | None:
+        tokenizer = self.processor.decoder_tokenizer
+        structure_ids: list[int] = [
+            tokenizer.convert_tokens_to_ids(token)  # type: ignore
+            for token, _ in OUTPUT_STRUCTURE
+        ]
+        if any(_id is None or _id == tokenizer.unk_token_id for _id in structure_ids):
+            logging.warning(
+                "The structure tokens are not in the vocab. Structure constraint is disabled."
+            )
+            return None
+
+        # stop at the first section end in the stop strings of each prompt
+        end_indices = []
+        for stop_strings in prompt_stop_strings:
+            end_index = len(structure_ids) - 1
+            for stop_string in stop_strings:
+                stop_token_id = tokenizer.convert_tokens_to_ids(stop_string)
+                if stop_token_id in structure_ids:
+                    end_index = min(end_index, structure_ids.index(stop_token_id))  # type: ignore
+            end_indices.append(end_index)
+
+        return StructureConstraintLogitsProcessor(
+            structure_ids=structure_ids,
+            content_states=[can_write for _, can_write in OUTPUT_STRUCTURE],
+            content_mask=self.get_tag_mask(),
+            end_index=end_indices,
+            max_length=max_length,
+        )
+
+    def _generate_ids(
+        self,
+        encoded_prompt: EncodedPrompt,
+        input_ids: torch.Tensor,  # (batch_size, seq_len)
+        attention_mask: torch.Tensor,
+        encoder_hidden_states: torch.Tensor,
+        encoder_attention_mask: torch.Tensor,
+        generation_config: GenerationConfig,
+        **generate_kwargs,
+    ) -> torch.Tensor:
+        past_key_values = None
+        if (
+            self.use_prefix_cache
+            and generation_config.num_beams == 1
+            and generation_config.num_return_sequences == 1
+        ):
+            # generate() does not expand the cache for beams or return sequences
+            past_key_values = self._get_prefix_past_key_values(
+                encoded_prompt, input_ids, attention_mask
+            )
+
+        if self.torch_compile:
+            # generate() compiles the decoding step when the cache is static.
+            # the static cache allocated in the warmup is reused to avoid recompilation
+            generation_config = copy.deepcopy(generation_config)
+            generation_config.cache_implementation = "static"
+            generation_config.compile_config = CompileConfig(
+                fullgraph=True,
+                mode="reduce-overhead",
+            )
+
+        with phase("decode"):
+            return self.model.generate(  # type: ignore
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=encoder_attention_mask,
+                generation_config=generation_config,
+                **generate_kwargs,
+            )
+
+    def get_token_texts(self) -> tuple[list[str], list[str]]:
+        """
+        Returns the id -> text tables of the decoder vocab,
+        with and without special tokens. Built once per loaded model.
+        """
+        if self._token_texts is None:
+            tokenizer = self.processor.decoder_tokenizer
+            all_ids = [[_id] for _id in range(len(tokenizer))]
+            self._token_texts = (
+                tokenizer.batch_decode(all_ids, skip_special_tokens=True),
+                tokenizer.batch_decode(all_ids, skip_special_tokens=False),
+            )
+        return self._token_texts
+
+    def decode_tokens(
+        self,
+        token_ids: list[int],
+        skip_special_tokens: bool = True,
+    ) -> list[str]:
+        texts, raw_texts = self.get_token_texts()
+        table = texts if skip_special_tokens else raw_texts
+
+        return [table[_id] if _id < len(table) else "" for _id in token_ids]
+
+    def decode_outputs(
+        self,
+        sequence_ids: list[int],
+        completion_start: int,
+    ) -> GenerationResult:
+        """
+        Decode a generated sequence into the full, completion and raw outputs at once
+        """
+        tokens = self.decode_tokens(sequence_ids)
+        raw_tokens = self.decode_tokens(sequence_ids, skip_special_tokens=False)
+
+        return (
+            self.join_tokens(tokens),
+            self.join_tokens(tokens[completion_start:]),
+            self.join_tokens(raw_tokens),
+        )
 
     def decode_ids(
         self,
         generated_ids: torch.Tensor,  # (token_length,)
         skip_special_tokens: bool = True,
     ) -> str:
-        # (token_length,) -> (token_length, 1)
-        generated_ids = generated_ids.unsqueeze(1)
-
-        return ", ".join(
-            [
-                token
-                for token in self.processor.decoder_tokenizer.batch_decode(
-                    generated_ids, skip_special_tokens=skip_special_tokens
-                )
-                if token.strip() != ""
-            ]
+        return self.join_tokens(
+            self.decode_tokens(
+                generated_ids.tolist(), skip_special_tokens=skip_special_tokens
+            )
         )
 
     def extract_translation_result(self, raw_output: str) -> dict[str, str]:
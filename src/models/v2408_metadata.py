@@ -0,0 +1,92 @@
+"""
+Lightweight definitions of the v2408 models used to register the nodes.
+This module must not import torch, transformers or comfy.
+"""
+
+from dataclasses import dataclass
+from typing import Literal
+import math
+
+from .metadata import AbstractTemplateConfig
+
+RATING_MAP = {
+    "general": "<|rating:general|>",
+    "sensitive": "<|rating:sensitive|>",
+    "questionable": "<|rating:questionable|>",
+    "explicit": "<|rating:explicit|>",
+}
+
+LENGTH_MAP = {
+    "very_short": "<|length:very_short|>",
+    "short": "<|length:short|>",
+    "long": "<|length:long|>",
+    "very_long": "<|length:very_long|>",
+}
+
+ASPECT_RATIO_MAP = {
+    "too_tall": "<|aspect_ratio:too_tall|>",
+    "tall_wallpaper": "<|aspect_ratio:tall_wallpaper|>",
+    "tall": "<|aspect_ratio:tall|>",
+    "square": "<|aspect_ratio:square|>",
+    "wide": "<|aspect_ratio:wide|>",
+    "wide_wallpaper": "<|aspect_ratio:wide_wallpaper|>",
+    "too_wide": "<|aspect_ratio:too_wide|>",
+}
+
+INPUT_END = "<|input_end|>"
+TRANSLATION_END = "<|reserved_6|>"
+EXTENSION_END = "</general>"
+
+# stop right after the section needed by each stage
+TRANSLATION_STOP_TOKENS = [TRANSLATION_END, "</translation>"]
+EXTENSION_STOP_TOKENS = [EXTENSION_END, "</extension>"]
+
+# the tag sections of the output in order,
+# and whether tags can be written after each token
+OUTPUT_STRUCTURE: list[tuple[str, bool]] = [
+    ("<copyright>", True),
+    ("</copyright>", False),
+    ("<character>", True),
+    ("</character>", False),
+    ("<general>", False),
+    ("<translation>", True),
+    ("</translation>", False),
+    ("<extension>", True),
+    ("</extension>", False),
+    ("</general>", False),
+]
+
+TEMPLATE_NAME = Literal["translation", "extension"]
+TEMPLATE_NAMES = ["translation", "extension"]
+
+
+def aspect_ratio_tag(
+    width: int,
+    height: int,
+) -> str:
+    """
+    Returns aspect ratio tag based on the aspect ratio of the image.
+    """
+    ar = math.log2(width / height)
+
+    if ar <= -1.25:
+        return "too_tall"
+    elif ar <= -0.75:
+        return "tall_wallpaper"
+    elif ar <= -0.25:
+        return "tall"
+    elif ar < 0.25:
+        return "square"
+    elif ar < 0.75:
+        return "wide"
+    elif ar < 1.25:
+        return "wide_wallpaper"
+    else:
+        return "too_wide"
+
+
+@dataclass
+class TemplateConfig(AbstractTemplateConfig):
+    aspect_ratio: str
+    rating: str
+    length: str
@@ -0,0 +1,457 @@
+from pathlib import Path
+from typing import Any
+import argparse
+import json
+import logging
+
+import numpy as np
+import torch
+from transformers import (
+    AutoModelForPreTraining,
+    AutoProcessor,
+    GenerationConfig,
+    LogitsProcessorList,
+    StoppingCriteriaList,
+    DynamicCache,
+    EncoderDecoderCache,
+)
+from transformers.generation.streamers import BaseStreamer
+
+from .v2408 import (
+    V2408Model,
+    TEMPLATE_NAME,
+    RESULT_CACHE_SIZE,
+    BAN_MASK_CACHE_SIZE,
+)
+from .utils import EncodedPrompt, resolve_commit_hash
+from .cache import ResultCache, LRUCache
+from .logits_processors import build_logits_warpers
+from .metrics import phase
+
+ENCODER_FILE_NAME = "encoder_model.onnx"
+DECODER_FILE_NAME = "decoder_model.onnx"
+DECODER_WITH_PAST_FILE_NAME = "decoder_with_past_model.onnx"
+METADATA_FILE_NAME = "danbot_onnx.json"
+
+DEFAULT_OPSET = 17
+
+
+def _flatten_past(past_key_values: Any) -> tuple[list[torch.Tensor], list[int]]:
+    """
+    Flatten the past key values into a list of tensors and the number of tensors per layer
+    """
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+
+    tensors, structure = [], []
+    for layer in past_key_values:
+        tensors.extend(layer)
+        structure.append(len(layer))
+    return tensors, structure
+
+
+def _unflatten_past(tensors: tuple[torch.Tensor, ...], structure: list[int]) -> Any:
+    layers, position = [], 0
+    for num_tensors in structure:
+        layers.append(tuple(tensors[position : position + num_tensors]))
+        position += num_tensors
+
+    if all(num_tensors == 4 for num_tensors in structure):
+        # self-attention and cross-attention key/values
+        return EncoderDecoderCache.from_legacy_cache(tuple(layers))
+    return DynamicCache.from_legacy_cache(tuple(layers))
+
+
+def _past_names(prefix: str, structure: list[int]) -> list[str]:
+    return [f"{prefix}.{i}" for i in range(sum(structure))]
+
+
+def _past_dynamic_axes(
+    names: list[str], structure: list[int], sequence_axis: str
+) -> dict[str, dict[int, str]]:
+    axes, position = {}, 0
+    for num_tensors in structure:
+        for j in range(num_tensors):
+            # the 3rd and 4th tensors of a layer are cross-attention key/values
+            length_axis = sequence_axis if j < 2 else "encoder_sequence_length"
+            axes[names[position]] = {0: "batch_size", 2: length_axis}
+            position += 1
+    return axes
+
+
+class _EncoderForExport(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.encoder_model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+        ).last_hidden_state
+
+
+class _DecoderForExport(torch.nn.Module):
+    def __init__(self, model, past_structure: list[int] | None = None):
+        super().__init__()
+        self.model = model
+        self.past_structure = past_structure
+
+    def forward(
+        self,
+        input_ids,
+        attention_mask,
+        encoder_hidden_states,
+        encoder_attention_mask,
+        *past_tensors,
+    ):
+        past_key_values = None
+        if self.past_structure is not None:
+            past_key_values = _unflatten_past(past_tensors, self.past_structure)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        present, _structure = _flatten_past(outputs.past_key_values)
+        return (outputs.logits, *present)
+
+
+@torch.inference_mode()
+def export_v2408_onnx(
+    model_name_or_path: str,
+    output_dir: str | Path,
+    revision: str | None = None,
+    trust_remote_code: bool = False,
+    opset: int = DEFAULT_OPSET,
+):
+    """
+    Export the encoder, decoder and decoder-with-past graphs of a v2408 model
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    model = AutoModelForPreTraining.from_pretrained(
+        model_name_or_path,
+        revision=revision,
+        torch_dtype=torch.float32,
+        trust_remote_code=trust_remote_code,
+        attn_implementation="eager",
+    ).eval()
+    processor = AutoProcessor.from_pretrained(
+        model_name_or_path,
+        revision=revision,
+        trust_remote_code=trust_remote_code,
+    )
+
+    encoder_inputs = processor.encoder_tokenizer(["1girl, solo"], return_tensors="pt")
+    decoder_inputs = processor.decoder_tokenizer(
+        ["<|bos|><|rating:general|>"], add_special_tokens=False, return_tensors="pt"
+    )
+
+    # 1. encoder
+    encoder = _EncoderForExport(model)
+    torch.onnx.export(
+        encoder,
+        (encoder_inputs.input_ids, encoder_inputs.attention_mask),
+        str(output_dir / ENCODER_FILE_NAME),
+        input_names=["input_ids", "attention_mask"],
+        output_names=["last_hidden_state"],
+        dynamic_axes={
+            "input_ids": {0: "batch_size", 1: "encoder_sequence_length"},
+            "attention_mask": {0: "batch_size", 1: "encoder_sequence_length"},
+            "last_hidden_state": {0: "batch_size", 1: "encoder_sequence_length"},
+        },
+        opset_version=opset,
+    )
+    encoder_hidden_states = encoder(
+        encoder_inputs.input_ids, encoder_inputs.attention_mask
+    )
+    decoder_args = (
+        decoder_inputs.input_ids,
+        decoder_inputs.attention_mask,
+        encoder_hidden_states,
+        encoder_inputs.attention_mask,
+    )
+    common_input_names = [
+        "input_ids",
+        "attention_mask",
+        "encoder_hidden_states",
+        "encoder_attention_mask",
+    ]
+    common_dynamic_axes = {
+        "input_ids": {0: "batch_size", 1: "sequence_length"},
+        "attention_mask": {0: "batch_size", 1: "total_sequence_length"},
+        "encoder_hidden_states": {0: "batch_size", 1: "encoder_sequence_length"},
+        "encoder_attention_mask": {0: "batch_size", 1: "encoder_sequence_length"},
+        "logits": {0: "batch_size", 1: "sequence_length"},
+    }
+
+    # 2. decoder without past, for the prefill step
+    decoder = _DecoderForExport(model)
+    present, past_structure = _flatten_past(
+        model(
+            input_ids=decoder_inputs.input_ids,
+            attention_mask=decoder_inputs.attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_inputs.attention_mask,
+            use_cache=True,
+        ).past_key_values
+    )
+    present_names = _past_names("present", past_structure)
+    torch.onnx.export(
+        decoder,
+        decoder_args,
+        str(output_dir / DECODER_FILE_NAME),
+        input_names=common_input_names,
+        output_names=["logits", *present_names],
+        dynamic_axes={
+            **common_dynamic_axes,
+            **_past_dynamic_axes(
+                present_names, past_structure, "total_sequence_length"
+            ),
+        },
+        opset_version=opset,
+    )
+
+    # 3. decoder with past, for the decoding steps
+    decoder_with_past = _DecoderForExport(model, past_structure=past_structure)
+    next_input_ids = decoder_inputs.input_ids[:, -1:]
+    next_attention_mask = torch.cat(
+        [decoder_inputs.attention_mask, torch.ones_like(next_input_ids)], dim=1
+    )
+    past_names = _past_names("past", past_structure)
+    torch.onnx.export(
+        decoder_with_past,
+        (
+            next_input_ids,
+            next_attention_mask,
+            encoder_hidden_states,
+            encoder_inputs.attention_mask,
+            *present,
+        ),
+        str(output_dir / DECODER_WITH_PAST_FILE_NAME),
+        input_names=[*common_input_names, *past_names],
+        output_names=["logits", *present_names],
+        dynamic_axes={
+            **common_dynamic_axes,
+            **_past_dynamic_axes(past_names, past_structure, "past_sequence_length"),
+            **_past_dynamic_axes(
+                present_names, past_structure, "total_sequence_length"
+            ),
+        },
+        opset_version=opset,
+    )
+
+    with open(output_dir / METADATA_FILE_NAME, "w") as f:
+        json.dump({"past_structure": past_structure}, f)
+
+    logging.info(f"Exported ONNX graphs to {output_dir}")
+
+
+class V2408OnnxModel(V2408Model):
+    """
+    v2408 model running on ONNX Runtime.
+    Export the graphs with `python -m src.models.v2408_onnx` first.
+    """
+
+    use_prefix_cache = False
+    supports_beam_search = False
+
+    def __init__(
+        self,
+        model_name_or_path: str,
+        prompt_templates: dict[TEMPLATE_NAME, str],
+        onnx_path: str,
+        revision: str | None = None,
+        trust_remote_code: bool = False,
+        onnx_providers: list[str] = ["CPUExecutionProvider"],
+        result_cache_path: str | None = None,
+        **kwargs,
+    ):
+        try:
+            import onnxruntime as ort  # type: ignore
+        except ImportError as e:
+            raise ImportError(
+                "onnxruntime is required for the onnx backend. "
+                "Install it with `pip install onnxruntime`."
+            ) from e
+
+        if len(kwargs) > 0:
+            logging.warning(f"Ignored options for the onnx backend: {list(kwargs)}")
+
+        self.precision = "fp32"
+        self.torch_compile = False
+
+        onnx_dir = Path(onnx_path)
+        with open(onnx_dir / METADATA_FILE_NAME, "r") as f:
+            self.past_structure: list[int] = json.load(f)["past_structure"]
+        self.encoder_session = ort.InferenceSession(
+            str(onnx_dir / ENCODER_FILE_NAME), providers=onnx_providers
+        )
+        self.decoder_session = ort.InferenceSession(
+            str(onnx_dir / DECODER_FILE_NAME), providers=onnx_providers
+        )
+        self.decoder_with_past_session = ort.InferenceSession(
+            str(onnx_dir / DECODER_WITH_PAST_FILE_NAME), providers=onnx_providers
+        )
+
+        self.processor = AutoProcessor.from_pretrained(
+            model_name_or_path,
+            revision=revision,
+            trust_remote_code=trust_remote_code,
+        )
+        self.prompt_templates = prompt_templates
+        commit_hash = resolve_commit_hash(model_name_or_path, revision)
+        self.model_id = f"{model_name_or_path}@{commit_hash or revision or 'main'}:onnx"
+        self.result_cache = ResultCache(
+            max_size=RESULT_CACHE_SIZE,
+            path=result_cache_path,
+        )
+
+        self._vocab_index = None
+        self._vocab_hash = None
+        self._ban_tags_cache = LRUCache(max_size=BAN_MASK_CACHE_SIZE)
+        self._ban_mask_tensors = LRUCache(max_size=BAN_MASK_CACHE_SIZE)
+        self._token_texts = None
+        self._tag_mask = None
+        self._prefix_cache = LRUCache(max_size=0)
+        self._init_tokenization()
+
+    @property
+    def device(self) -> torch.device:
+        return torch.device("cpu")
+
+    def load_to_device(self):
+        pass  # the sessions manage their own memory
+
+    def offload(self):
+        pass
+
+    def _encode_ids(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        (last_hidden_state,) = self.encoder_session.run(
+            ["last_hidden_state"],
+            {
+                "input_ids": input_ids.numpy(),
+                "attention_mask": attention_mask.numpy(),
+            },
+        )
+        return torch.from_numpy(last_hidden_state)
+
+    def _generate_ids(
+        self,
+        encoded_prompt: EncodedPrompt,
+        input_ids: torch.Tensor,  # (batch_size, seq_len)
+        attention_mask: torch.Tensor,
+        encoder_hidden_states: torch.Tensor,
+        encoder_attention_mask: torch.Tensor,
+        generation_config: GenerationConfig,
+        logits_processor: LogitsProcessorList = LogitsProcessorList(),
+        stopping_criteria: StoppingCriteriaList = StoppingCriteriaList(),
+        streamer: BaseStreamer | None = None,
+        eos_token_id: int | list[int] | torch.Tensor | None = None,
+        pad_token_id: int | None = None,
+        **generate_kwargs,
+    ) -> torch.Tensor:
+        if generation_config.num_beams > 1:
+            logging.warning("Beam search is not supported by the onnx backend.")
+        if generation_config.num_return_sequences > 1:
+            num_return_sequences = generation_config.num_return_sequences
+            input_ids = input_ids.repeat_interleave(num_return_sequences, dim=0)
+            attention_mask = attention_mask.repeat_interleave(num_return_sequences, dim=0)
+            encoder_hidden_states = encoder_hidden_states.repeat_interleave(
+                num_return_sequences, dim=0
+            )
+            encoder_attention_mask = encoder_attention_mask.repeat_interleave(
+                num_return_sequences, dim=0
+            )
+
+        stop_token_ids = torch.tensor(
+            [] if eos_token_id is None else eos_token_id
+        ).flatten()
+        pad_token_id = pad_token_id if pad_token_id is not None else 0
+        max_new_tokens = generation_config.max_new_tokens or 20
+        logits_warper = build_logits_warpers(generation_config)
+
+        feeds: dict[str, np.ndarray] = {
+            "input_ids": input_ids.numpy(),
+            "attention_mask": attention_mask.numpy(),
+            "encoder_hidden_states": encoder_hidden_states.contiguous().numpy(),
+            "encoder_attention_mask": encoder_attention_mask.contiguous().numpy(),
+        }
+        with phase("prefill"):
+            logits, *present = self.decoder_session.run(None, feeds)
+
+        with phase("decode"):
+            sequences = input_ids
+            unfinished = torch.ones(input_ids.size(0), dtype=torch.bool)
+            if streamer is not None:
+                streamer.put(input_ids)
+            for _ in range(max_new_tokens):
+                scores = torch.from_numpy(logits[:, -1, :]).float()
+                scores = logits_processor(sequences, scores)  # type: ignore
+
+                if generation_config.do_sample:
+                    scores = logits_warper(sequences, scores)  # type: ignore
+                    probs = torch.softmax(scores, dim=-1)
+                    next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+                else:
+                    next_tokens = torch.argmax(scores, dim=-1)
+
+                next_tokens = torch.where(unfinished, next_tokens, pad_token_id)
+                sequences = torch.cat([sequences, next_tokens[:, None]], dim=1)
+                if streamer is not None:
+                    streamer.put(next_tokens)
+                attention_mask = torch.cat(
+                    [attention_mask, torch.ones_like(next_tokens[:, None])], dim=1
+                )
+                unfinished &= ~torch.isin(next_tokens, stop_token_ids)
+                unfinished &= ~stopping_criteria(sequences, scores)  # type: ignore
+                if not unfinished.any():
+                    break
+
+                feeds["input_ids"] = next_tokens[:, None].numpy()
+                feeds["attention_mask"] = attention_mask.numpy()
+                for name, tensor in zip(
+                    _past_names("past", self.past_structure), present
+                ):
+                    feeds[name] = tensor
+                logits, *present = self.decoder_with_past_session.run(None, feeds)
+
+        if streamer is not None:
+            streamer.end()
+
+        return sequences
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export a v2408 Danbot model to ONNX graphs"
+    )
+    parser.add_argument("model_name_or_path", type=str)
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument("--revision", type=str, default=None)
+    parser.add_argument("--trust_remote_code", action="store_true")
+    parser.add_argument("--opset", type=int, default=DEFAULT_OPSET)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    export_v2408_onnx(
+        args.model_name_or_path,
+        args.output_dir,
+        revision=args.revision,
+        trust_remote_code=args.trust_remote_code,
+        opset=args.opset,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+from bisect import bisect_left
+import threading
+
+WILDCARD = "*"
+NGRAM_SIZE = 3
+
+
+def _ngrams(text: str, n: int = NGRAM_SIZE) -> set[str]:
+    return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+
+def _range_with_prefix(sorted_texts: list[str], prefix: str) -> list[str]:
+    # all texts starting with the prefix are contiguous in the sorted list
+    start = bisect_left(sorted_texts, prefix)
+    end = start
+    while end < len(sorted_texts) and sorted_texts[end].startswith(prefix):
+        end += 1
+    return sorted_texts[start:end]
+
+
+def wildcard_match(token: str, parts: list[str]) -> bool:
+    """
+    Match a token against the wildcard pattern split by "*"
+    """
+    prefix, *middles, suffix = parts
+    if len(token) < len(prefix) + len(suffix):
+        return False
+    if not (token.startswith(prefix) and token.endswith(suffix)):
+        return False
+
+    # the infix parts must appear in order between the prefix and the suffix
+    position, end = len(prefix), len(token) - len(suffix)
+    for middle in middles:
+        found = token.find(middle, position, end)
+        if found < 0:
+            return False
+        position = found + len(middle)
+
+    return True
+
+
+class VocabIndex:
+    """
+    Index of a tokenizer vocabulary to answer exact and wildcard queries.
+
+    - prefix (`tag*`): binary search over the sorted tokens
+    - suffix (`*tag`): binary search over the sorted reversed tokens
+    - infix (`*tag*`): n-gram index narrowed candidates
+
+    The query results are cached for the lifetime of the index.
+    """
+
+    def __init__(self, vocab: dict[str, int]):
+        self.vocab = vocab
+
+        self.sorted_tokens = sorted(vocab.keys())
+        self.sorted_reversed_tokens = sorted(token[::-1] for token in vocab.keys())
+        self._ngram_index: dict[str, set[str]] | None = None  # built lazily
+
+        self._cache: dict[str, tuple[int, ...]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ngram_index(self) -> dict[str, set[str]]:
+        with self._lock:
+            if self._ngram_index is None:
+                ngram_index: dict[str, set[str]] = {}
+                for token in self.vocab.keys():
+                    for ngram in _ngrams(token):
+                        ngram_index.setdefault(ngram, set()).add(token)
+                self._ngram_index = ngram_index
+
+        return self._ngram_index
+
+    def _infix_candidates(self, infix: str) -> set[str] | None:
+        if len(infix) < NGRAM_SIZE:
+            return None  # too short to narrow down
+
+        candidates: set[str] | None = None
+        for ngram in _ngrams(infix):
+            tokens = self.ngram_index.get(ngram, set())
+            candidates = tokens if candidates is None else candidates & tokens
+            if len(candidates) == 0:
+                break
+
+        return candidates
+
+    def clear_cache(self):
+        """
+        Forget the cached query results, e.g. to measure the search itself
+        """
+        self._cache.clear()
+
+    def search(self, pattern: str) -> tuple[int, ...]:
+        """
+        Returns the ids of the tokens matching the pattern.
+        `*` matches any sequence of characters.
+        """
+        if pattern in self._cache:
+            return self._cache[pattern]
+
+        if WILDCARD not in pattern:
+            ids = (self.vocab[pattern],) if pattern in self.vocab else ()
+            self._cache[pattern] = ids
+            return ids
+
+        parts = pattern.split(WILDCARD)
+        prefix, *middles, suffix = parts
+
+        candidates: set[str] | None = None
+        if prefix:
+            candidates = set(_range_with_prefix(self.sorted_tokens, prefix))
+        if suffix:
+            tokens = {
+                token[::-1]
+                for token in _range_with_prefix(
+                    self.sorted_reversed_tokens, suffix[::-1]
+                )
+            }
+            candidates = tokens if candidates is None else candidates & tokens
+        for middle in middles:
+            tokens = self._infix_candidates(middle)
+            if tokens is not None:
+                candidates = tokens if candidates is None else candidates & tokens
+
+        if candidates is None:
+            # e.g. "*" or "*a*", fall back to scanning the whole vocab
+            candidates = set(self.vocab.keys())
+
+        ids = tuple(
+            sorted(
+                self.vocab[token]
+                for token in candidates
+                if wildcard_match(token, parts)
+            )
+        )
+        self._cache[pattern] = ids
+        return ids
@@ -1,11 +1,11 @@
-from .generator import GeneratorNode
+from .generator import GeneratorNode, BatchGeneratorNode, SeedSweepGeneratorNode
 from .pipeline import V2408PipelineNode
 from .load_model import LoadModelNode
 from .auto_aspect_ratio_tag import V2408AutoAspectRatioTagNode
 from .generation_config import GenerationConfigNode
 from .formatter import V2408FormatterNode, V2408TemplateConfigNode
 from .extractor import TranslationExtractorNode, ExtensionExtractorNode
-from .ban_tags import LoadBanTagsNode
+from .ban_tags import LoadBanTagsNode, LoadBanMaskNode, BanMaskSetOperationNode
 
 from .utils.print_string import PrintStringNode
 from .utils.concat_string import ConcatStringNode
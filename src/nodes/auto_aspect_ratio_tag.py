@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 
-from ..models import v2408
+from ..models import v2408_metadata as v2408
 from .type import DANBOT_CATEGORY
 
 
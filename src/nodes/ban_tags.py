@@ -1,21 +1,28 @@
-import os
-from pathlib import Path
+from typing import TYPE_CHECKING
 
-from ..tags import TAGS_ROOT_DIR, load_tags, normalize_tag_text
-from .type import DANBOT_CATEGORY
+from ..file_cache import CachedDirectory
+from ..tags import BAN_TEMPLATE_DIR, parse_tags, normalize_tag_text
+from .type import DANBOT_MODEL_TYPE, DANBOT_BAN_MASK_TYPE, DANBOT_CATEGORY
 
-BAN_TEMPLATE_DIR = TAGS_ROOT_DIR / "ban_template"
+# numpy and torch are imported on the first execution
+if TYPE_CHECKING:
+    from ..models.ban_mask import BanMask
+    from ..models.utils import ModelWrapper
 
+# listed and parsed again only when the files change
+BAN_TEMPLATES = CachedDirectory(BAN_TEMPLATE_DIR, suffix=".txt")
 
-def list_ban_template_files(dir: Path):
-    files = os.listdir(BAN_TEMPLATE_DIR)
-    files = [file for file in files if file.endswith(".txt")]
 
-    return files
+def list_ban_template_files() -> list[str]:
+    return BAN_TEMPLATES.list_files()
 
 
-def load_ban_template(file: str):
-    return load_tags(BAN_TEMPLATE_DIR / file)
+def load_ban_template(file: str) -> list[str]:
+    return list(BAN_TEMPLATES.file(file, parse_tags).get())
+
+
+def ban_template_hash(file: str) -> str:
+    return BAN_TEMPLATES.file(file, parse_tags).content_hash
 
 
 class LoadBanTagsNode:
@@ -24,7 +31,7 @@ class LoadBanTagsNode:
 
     @classmethod
     def INPUT_TYPES(s):
-        files = list_ban_template_files(BAN_TEMPLATE_DIR)
+        files = list_ban_template_files()
 
         return {
             "optional": {
@@ -42,12 +49,138 @@ class LoadBanTagsNode:
 
     CATEGORY = DANBOT_CATEGORY
 
+    @classmethod
+    def IS_CHANGED(s, template_name: str | None = None):
+        # the output changes only when the content of the template changes
+        return ban_template_hash(template_name) if template_name else ""
+
     def compose(
         self,
-        template: str | None,
+        template_name: str | None = None,
     ):
-        tags = load_ban_template(template) if template else []
+        tags = load_ban_template(template_name) if template_name else []
 
         tag_text = normalize_tag_text(",".join(tags))
 
         return (tag_text,)
+
+
+NO_TEMPLATE = "none"
+
+BAN_MASK_OPERATIONS = ["union", "difference", "intersection"]
+
+
+class LoadBanMaskNode:
+    DESCRIPTION = (
+        "Compiles a ban template and ban tags into a ban mask of the model vocabulary."
+    )
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+        files = list_ban_template_files()
+
+        return {
+            "required": {
+                "danbot_model": (DANBOT_MODEL_TYPE,),
+                "template_name": ([NO_TEMPLATE] + files,),
+            },
+            "optional": {
+                "ban_tags": (
+                    "STRING",
+                    {
+                        "default": "",
+                        "multiline": True,
+                        "tooltip": "Comma separated tags to ban. * matches any characters.",
+                    },
+                ),
+            },
+        }
+
+    RETURN_TYPES = (DANBOT_BAN_MASK_TYPE,)
+    RETURN_NAMES = ("ban_mask",)
+    OUTPUT_TOOLTIPS = ("Union of the template and the ban tags",)
+
+    FUNCTION = "load"
+
+    OUTPUT_NODE = False
+
+    CATEGORY = DANBOT_CATEGORY
+
+    @classmethod
+    def IS_CHANGED(s, template_name: str, **kwargs):
+        if template_name == NO_TEMPLATE:
+            return ""
+        return ban_template_hash(template_name)
+
+    def load(
+        self,
+        danbot_model: "ModelWrapper",
+        template_name: str,
+        ban_tags: str = "",
+    ):
+        # normalized like the tags of the templates
+        ban_mask = danbot_model.compile_ban_tags(normalize_tag_text(ban_tags))
+        # the template is compiled once and memory-mapped from tags/ban_template/.compiled
+        if template_name != NO_TEMPLATE:
+            ban_mask = ban_mask | danbot_model.compile_ban_template(
+                BAN_TEMPLATE_DIR / template_name
+            )
+
+        return (ban_mask,)
+
+
+class BanMaskSetOperationNode:
+    DESCRIPTION = "Combines two ban masks with a set operation."
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "ban_mask_a": (DANBOT_BAN_MASK_TYPE,),
+                "ban_mask_b": (DANBOT_BAN_MASK_TYPE,),
+                "operation": (
+                    BAN_MASK_OPERATIONS,
+                    {
+                        "default": "union",
+                        "tooltip": (
+                            "union: banned in A or B. "
+                            "difference: banned in A and not in B. "
+                            "intersection: banned in both A and B."
+                        ),
+                    },
+                ),
+            },
+        }
+
+    RETURN_TYPES = (DANBOT_BAN_MASK_TYPE,)
+    RETURN_NAMES = ("ban_mask",)
+    OUTPUT_TOOLTIPS = ("Combined ban mask",)
+
+    FUNCTION = "combine"
+
+    OUTPUT_NODE = False
+
+    CATEGORY = DANBOT_CATEGORY
+
+    def combine(
+        self,
+        ban_mask_a: "BanMask",
+        ban_mask_b: "BanMask",
+        operation: str,
+    ):
+        assert operation in BAN_MASK_OPERATIONS, f"Unknown operation: {operation}"
+
+        if operation == "union":
+            ban_mask = ban_mask_a | ban_mask_b
+        elif operation == "difference":
+            ban_mask = ban_mask_a - ban_mask_b
+        else:
+            ban_mask = ban_mask_a & ban_mask_b
+
+        return (ban_mask,)
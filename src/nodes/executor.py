@@ -0,0 +1,135 @@
+from typing import TYPE_CHECKING
+import asyncio
+import threading
+
+from ..config import load_executor_config
+from ..models.cache import GenerationResult
+from ..models.executor import GenerationExecutor
+
+if TYPE_CHECKING:
+    from transformers import GenerationConfig
+
+    from ..models.utils import ModelWrapper, EncodedPrompt
+
+_executor: GenerationExecutor | None = None
+_executor_loaded = False
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> GenerationExecutor | None:
+    """
+    Returns the shared generation executor, or None if it is disabled in executor.yml
+    """
+    global _executor, _executor_loaded
+
+    with _executor_lock:
+        if not _executor_loaded:
+            _executor = load_executor_config().create_executor()
+            _executor_loaded = True
+
+    return _executor
+
+
+async def run_generation(
+    model: "ModelWrapper",
+    text_prompt: str,
+    tag_template: str,
+    generation_config: "GenerationConfig",
+    seed: int | None,
+    encoded_prompt: "EncodedPrompt | None" = None,
+    **kwargs,
+) -> GenerationResult:
+    """
+    Generate on the shared executor if enabled, otherwise on the current thread.
+    While the executor generates, ComfyUI runs the other nodes and their requests can be
+    coalesced. The random state is not reset when `seed` is None.
+    """
+    results = await run_generation_batch(
+        model,
+        text_prompts=[text_prompt],
+        tag_templates=[tag_template],
+        generation_config=generation_config,
+        seed=seed,
+        encoded_prompt=encoded_prompt,
+        **kwargs,
+    )
+    return results[0]
+
+
+async def run_generation_batch(
+    model: "ModelWrapper",
+    text_prompts: list[str],
+    tag_templates: list[str],
+    generation_config: "GenerationConfig",
+    seed: int | None,
+    encoded_prompt: "EncodedPrompt | None" = None,
+    **kwargs,
+) -> list[GenerationResult]:
+    """
+    Batched version of `run_generation`. A single prompt or template is used for all rows.
+    """
+    executor = get_executor()
+    if executor is not None:
+        future = executor.submit(
+            model,
+            text_prompts=text_prompts,
+            tag_templates=tag_templates,
+            generation_config=generation_config,
+            seed=seed,
+            encoded_prompt=encoded_prompt,
+            **kwargs,
+        )
+        return await asyncio.wrap_future(future)
+
+    if seed is not None:
+        from transformers import set_seed
+
+        set_seed(seed)
+    if encoded_prompt is not None:
+        return model.generate_batch_from_encoded(
+            encoded_prompt,
+            tag_templates=tag_templates,
+            generation_config=generation_config,
+            **kwargs,
+        )
+    return model.generate_batch(
+        text_prompts=text_prompts,
+        tag_templates=tag_templates,
+        generation_config=generation_config,
+        **kwargs,
+    )
+
+
+async def run_variants(
+    model: "ModelWrapper",
+    text_prompt: str,
+    tag_template: str,
+    generation_config: "GenerationConfig",
+    seed: int,
+    num_variants: int,
+    **kwargs,
+) -> list[GenerationResult]:
+    """
+    Generate the variants of `ModelWrapper.generate_variants` on the shared executor if enabled
+    """
+    executor = get_executor()
+    if executor is not None:
+        future = executor.submit(
+            model,
+            text_prompts=[text_prompt],
+            tag_templates=[tag_template],
+            generation_config=generation_config,
+            seed=seed,
+            num_variants=num_variants,
+            **kwargs,
+        )
+        return await asyncio.wrap_future(future)
+
+    return model.generate_variants(
+        text_prompt=text_prompt,
+        tag_template=tag_template,
+        generation_config=generation_config,
+        seed=seed,
+        num_variants=num_variants,
+        **kwargs,
+    )
@@ -1,6 +1,10 @@
-from ..models.utils import ModelWrapper
+from typing import TYPE_CHECKING
+
 from .type import DANBOT_MODEL_TYPE, FORMAT_KWARGS_DTYPE, DANBOT_CATEGORY
 
+if TYPE_CHECKING:
+    from ..models.utils import ModelWrapper
+
 
 class TranslationExtractorNode:
     @classmethod
@@ -28,7 +32,7 @@ class TranslationExtractorNode:
 
     def extract(
         self,
-        danbot_model: ModelWrapper,
+        danbot_model: "ModelWrapper",
         generated_tags: str,
     ):
         translation = danbot_model.extract_translation_result(generated_tags)
@@ -62,7 +66,7 @@ class ExtensionExtractorNode:
 
     def extract(
         self,
-        danbot_model: ModelWrapper,
+        danbot_model: "ModelWrapper",
         generated_tags: str,
     ):
         extension = danbot_model.extract_extension_result(generated_tags)
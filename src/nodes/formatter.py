@@ -1,5 +1,6 @@
-from ..models.utils import ModelWrapper
-from ..models import v2408
+from typing import TYPE_CHECKING
+
+from ..models import v2408_metadata as v2408
 from .type import (
     DANBOT_MODEL_TYPE,
     DANBOT_CATEGORY,
@@ -7,6 +8,9 @@ from .type import (
     TEMPLATE_CONFIG_DTYPE,
 )
 
+if TYPE_CHECKING:
+    from ..models.utils import ModelWrapper
+
 STRING_OPTIONS = {
     "multiline": True,
 }
@@ -138,7 +142,7 @@ class V2408FormatterNode(FormatterNodeMixin):
 
     def format(
         self,
-        model: ModelWrapper,
+        model: "ModelWrapper",
         template_config: v2408.TemplateConfig,
         template_name: v2408.TEMPLATE_NAME,
         format_kwargs: dict[str, str] = {},
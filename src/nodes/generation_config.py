@@ -1,7 +1,5 @@
 from typing import Literal
 
-from transformers import GenerationConfig
-
 from .type import DANBOT_GENERATION_CONFIG_TYPE, DANBOT_CATEGORY
 
 
@@ -106,7 +104,26 @@ class GenerationConfigNode:
                         ),
                     },
                 ),
-            }
+            },
+            "optional": {
+                "constrain_structure": (
+                    ["true", "false"],
+                    {
+                        "default": "false",
+                        "tooltip": (
+                            "Whether to only allow the valid tag section tokens at each position. "
+                            "The sections are closed before reaching max_new_tokens."
+                        ),
+                    },
+                ),
+                "suppress_duplicate_tags": (
+                    ["true", "false"],
+                    {
+                        "default": "false",
+                        "tooltip": "Whether to prevent generating the tags that are already in the template or the output.",
+                    },
+                ),
+            },
         }
 
     RETURN_TYPES = (DANBOT_GENERATION_CONFIG_TYPE,)
@@ -128,7 +145,11 @@ class GenerationConfigNode:
         top_k: int,
         min_p: float,
         num_beams: int,
+        constrain_structure: Literal["true", "false"] = "false",
+        suppress_duplicate_tags: Literal["true", "false"] = "false",
     ):
+        from transformers import GenerationConfig
+
         config = GenerationConfig(
             max_new_tokens=max_new_tokens,
             do_sample=do_sample == "true",
@@ -138,5 +159,8 @@ class GenerationConfigNode:
             min_p=min_p,
             num_beams=num_beams,
             use_cache=True,
+            # danbot specific options
+            constrain_structure=constrain_structure == "true",
+            suppress_duplicate_tags=suppress_duplicate_tags == "true",
         )
         return (config,)
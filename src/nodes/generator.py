@@ -1,12 +1,24 @@
-from transformers import GenerationConfig, set_seed
+from typing import TYPE_CHECKING
+import json
 
-from ..models.utils import ModelWrapper
+from ..models.metadata import split_tokens
+from ..models.metrics import collect_metrics
+from .executor import run_generation, run_generation_batch, run_variants
+from .stream import create_streamer
 from .type import (
     DANBOT_MODEL_TYPE,
     DANBOT_GENERATION_CONFIG_TYPE,
+    DANBOT_BAN_MASK_TYPE,
     DANBOT_CATEGORY,
 )
 
+# torch and transformers are imported on the first execution
+if TYPE_CHECKING:
+    from transformers import GenerationConfig
+
+    from ..models.ban_mask import BanMask
+    from ..models.utils import ModelWrapper
+
 UPSAMPLER_INPUT_TYPES = {
     "required": {
         "danbot_model": (DANBOT_MODEL_TYPE,),
@@ -40,7 +52,7 @@ UPSAMPLER_INPUT_TYPES = {
             "STRING",
             {
                 "default": "</general>",
-                "tooltip": "Stop token to stop generation",
+                "tooltip": "Stop tokens to stop generation. Multiple stop tokens can be separated by commas.",
             },
         ),
         "ban_tags": (
@@ -50,6 +62,12 @@ UPSAMPLER_INPUT_TYPES = {
                 "tooltip": "Tags to ban during generation",
             },
         ),
+        "ban_mask": (
+            DANBOT_BAN_MASK_TYPE,
+            {
+                "tooltip": "Compiled ban mask. Combined with ban_tags if both are given.",
+            },
+        ),
         "generation_config": (
             DANBOT_GENERATION_CONFIG_TYPE,
             {
@@ -66,19 +84,27 @@ class GeneratorNode:
 
     @classmethod
     def INPUT_TYPES(s):
-        return UPSAMPLER_INPUT_TYPES
+        return {
+            **UPSAMPLER_INPUT_TYPES,
+            "hidden": {
+                "unique_id": "UNIQUE_ID",  # used to stream the generated tags
+            },
+        }
 
     RETURN_TYPES = (
         "STRING",
         "STRING",
+        "STRING",
     )
     RETURN_NAMES = (
         "generated_tags",
         "raw_output",
+        "metrics",
     )
     OUTPUT_TOOLIPS = (
         "The generated tags by the model.",
         "The raw output of the model. This includes the special tokens.",
+        "Timing and token counts of the generation in JSON.",
     )
 
     FUNCTION = "upsample"
@@ -87,25 +113,246 @@ class GeneratorNode:
 
     CATEGORY = DANBOT_CATEGORY
 
-    def upsample(
+    async def upsample(
         self,
-        danbot_model: ModelWrapper,
+        danbot_model: "ModelWrapper",
         text_prompt: str,
         tag_template: str,
         seed: int,
         stop_token: str | None = "</general>",
         ban_tags: str | None = None,
-        generation_config: GenerationConfig = GenerationConfig(
-            do_sample=False,
+        ban_mask: "BanMask | None" = None,
+        generation_config: "GenerationConfig | None" = None,
+        unique_id: str | None = None,
+    ):
+        from transformers import GenerationConfig
+
+        if generation_config is None:
+            generation_config = GenerationConfig(do_sample=False)
+
+        with collect_metrics() as metrics:
+            _full, new, raw = await run_generation(
+                danbot_model,
+                text_prompt=text_prompt,
+                tag_template=tag_template,
+                generation_config=generation_config,
+                seed=seed,
+                ban_tags=ban_tags,
+                ban_mask=ban_mask,
+                stop_token=split_tokens(stop_token) if stop_token else None,
+                streamer=create_streamer(danbot_model, generation_config, unique_id),
+            )
+
+        return (new, raw, json.dumps(metrics.to_dict()))
+
+
+BATCH_UPSAMPLER_INPUT_TYPES = {
+    "required": {
+        **UPSAMPLER_INPUT_TYPES["required"],
+        "text_prompt": (
+            "STRING",
+            {
+                "forceInput": True,
+                "tooltip": "Natural language prompts. Each line or each list item is treated as a separate prompt.",
+            },
+        ),
+        "tag_template": (
+            "STRING",
+            {
+                "forceInput": True,
+                "tooltip": "Formatted tag template. A single template is shared by all prompts.",
+            },
+        ),
+        "batch_size": (
+            "INT",
+            {
+                "default": 8,
+                "step": 1,
+                "min": 1,
+                "max": 256,
+                "display": "number",
+                "tooltip": "Number of prompts to generate in one forward pass",
+            },
         ),
+    },
+    "optional": UPSAMPLER_INPUT_TYPES["optional"],
+}
+
+
+def split_prompt_lines(
+    text_prompts: list[str],
+    tag_templates: list[str],
+) -> tuple[list[str], list[str]]:
+    """
+    Split newline-separated prompts and remove empty lines.
+    The template of each prompt item is repeated for all of its lines.
+    """
+    if len(tag_templates) == 1:
+        tag_templates = tag_templates * len(text_prompts)
+    assert len(text_prompts) == len(tag_templates), (
+        f"Number of prompts ({len(text_prompts)}) and templates ({len(tag_templates)}) mismatch."
+    )
+
+    prompts, templates = [], []
+    for text, template in zip(text_prompts, tag_templates):
+        for line in text.splitlines():
+            if line.strip():
+                prompts.append(line.strip())
+                templates.append(template)
+
+    return prompts, templates
+
+
+class BatchGeneratorNode:
+    DESCRIPTION = "Generates tags for multiple prompts in batches."
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return BATCH_UPSAMPLER_INPUT_TYPES
+
+    INPUT_IS_LIST = True
+
+    RETURN_TYPES = (
+        "STRING",
+        "STRING",
+    )
+    RETURN_NAMES = (
+        "generated_tags",
+        "raw_output",
+    )
+    OUTPUT_TOOLIPS = (
+        "The list of generated tags by the model.",
+        "The list of raw outputs of the model. This includes the special tokens.",
+    )
+    OUTPUT_IS_LIST = (True, True)
+
+    FUNCTION = "upsample"
+
+    OUTPUT_NODE = False
+
+    CATEGORY = DANBOT_CATEGORY
+
+    async def upsample(
+        self,
+        danbot_model: list["ModelWrapper"],
+        text_prompt: list[str],
+        tag_template: list[str],
+        seed: list[int],
+        batch_size: list[int],
+        stop_token: list[str | None] = ["</general>"],
+        ban_tags: list[str | None] = [None],
+        ban_mask: list["BanMask | None"] = [None],
+        generation_config: list["GenerationConfig | None"] = [None],
     ):
-        set_seed(seed)
-        _full, new, raw = danbot_model.generate(
+        from transformers import GenerationConfig
+
+        # all inputs are passed as lists, so take the first item of the scalar inputs
+        model = danbot_model[0]
+        text_prompts, tag_templates = split_prompt_lines(text_prompt, tag_template)
+        chunk_size = batch_size[0]
+        config = generation_config[0] or GenerationConfig(do_sample=False)
+
+        generated_tags, raw_outputs = [], []
+        for i in range(0, len(text_prompts), chunk_size):
+            outputs = await run_generation_batch(
+                model,
+                text_prompts=text_prompts[i : i + chunk_size],
+                tag_templates=tag_templates[i : i + chunk_size],
+                generation_config=config,
+                # the later chunks continue from the random state of the first one
+                seed=seed[0] if i == 0 else None,
+                ban_tags=ban_tags[0],
+                ban_mask=ban_mask[0],
+                stop_token=split_tokens(stop_token[0]) if stop_token[0] else None,
+            )
+            for _full, new, raw in outputs:
+                generated_tags.append(new)
+                raw_outputs.append(raw)
+
+        return (generated_tags, raw_outputs)
+
+
+SEED_SWEEP_INPUT_TYPES = {
+    "required": {
+        **UPSAMPLER_INPUT_TYPES["required"],
+        "num_variants": (
+            "INT",
+            {
+                "default": 4,
+                "step": 1,
+                "min": 1,
+                "max": 64,
+                "display": "number",
+                "tooltip": "Number of variants to generate. The i-th variant uses seed + i.",
+            },
+        ),
+    },
+    "optional": UPSAMPLER_INPUT_TYPES["optional"],
+}
+
+
+class SeedSweepGeneratorNode:
+    DESCRIPTION = "Generates multiple variants of the same prompt with consecutive seeds in one batch."
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return SEED_SWEEP_INPUT_TYPES
+
+    RETURN_TYPES = (
+        "STRING",
+        "STRING",
+    )
+    RETURN_NAMES = (
+        "generated_tags",
+        "raw_output",
+    )
+    OUTPUT_TOOLIPS = (
+        "The list of generated tags by the model.",
+        "The list of raw outputs of the model. This includes the special tokens.",
+    )
+    OUTPUT_IS_LIST = (True, True)
+
+    FUNCTION = "upsample"
+
+    OUTPUT_NODE = False
+
+    CATEGORY = DANBOT_CATEGORY
+
+    async def upsample(
+        self,
+        danbot_model: "ModelWrapper",
+        text_prompt: str,
+        tag_template: str,
+        seed: int,
+        num_variants: int,
+        stop_token: str | None = "</general>",
+        ban_tags: str | None = None,
+        ban_mask: "BanMask | None" = None,
+        generation_config: "GenerationConfig | None" = None,
+    ):
+        from transformers import GenerationConfig
+
+        if generation_config is None:
+            generation_config = GenerationConfig(do_sample=True)
+
+        outputs = await run_variants(
+            danbot_model,
             text_prompt=text_prompt,
             tag_template=tag_template,
             generation_config=generation_config,
+            seed=seed,
+            num_variants=num_variants,
             ban_tags=ban_tags,
-            stop_token=stop_token,
+            ban_mask=ban_mask,
+            stop_token=split_tokens(stop_token) if stop_token else None,
         )
+        generated_tags = [new for _full, new, _raw in outputs]
+        raw_outputs = [raw for _full, _new, raw in outputs]
 
-        return (new, raw)
+        return (generated_tags, raw_outputs)
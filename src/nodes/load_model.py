@@ -1,4 +1,8 @@
-from ..config import load_models_configs
+from typing import Literal
+
+from ..config import load_models_configs, models_configs_hash
+from ..models.metadata import PRECISION_TYPE, PRECISION_TYPES
+from ..models.registry import MODEL_REGISTRY, ModelKey
 from .type import DANBOT_MODEL_TYPE, DANBOT_CATEGORY
 
 
@@ -6,7 +10,11 @@ class LoadModelNode:
     DESCRIPTION = "Loads a Danbot model."
 
     def __init__(self):
-        pass
+        self.model_key: ModelKey | None = None
+
+    def __del__(self):
+        if self.model_key is not None:
+            MODEL_REGISTRY.release(self.model_key)
 
     @classmethod
     def INPUT_TYPES(s):
@@ -15,6 +23,19 @@ class LoadModelNode:
             "required": {
                 "model_name": (list(configs.keys()),),
             },
+            "optional": {
+                "precision": (
+                    ["auto"] + PRECISION_TYPES,
+                    {
+                        "default": "auto",
+                        "tooltip": (
+                            "Precision of the model weights. "
+                            '"auto" uses the precision in models.yml. '
+                            "int8 dynamic quantization runs on CPU."
+                        ),
+                    },
+                ),
+            },
         }
 
     RETURN_TYPES = (DANBOT_MODEL_TYPE,)
@@ -27,8 +48,26 @@ class LoadModelNode:
 
     CATEGORY = DANBOT_CATEGORY
 
-    def load_model(self, model_name: str):
+    @classmethod
+    def IS_CHANGED(s, model_name: str, precision: str = "auto"):
+        # reload only when models.yml or prompt_templates.yml is edited
+        return models_configs_hash()
+
+    def load_model(
+        self,
+        model_name: str,
+        precision: PRECISION_TYPE | Literal["auto"] = "auto",
+    ):
         configs = load_models_configs()
         config = configs[model_name]
-        model = config.load_model()
+        if precision != "auto":
+            config = config.with_precision(precision)
+        model_key = config.cache_key()
+        model = MODEL_REGISTRY.acquire(model_key, config.load_model)
+
+        # release the previously loaded model of this node
+        if self.model_key is not None:
+            MODEL_REGISTRY.release(self.model_key)
+        self.model_key = model_key
+
         return (model,)
@@ -1,15 +1,26 @@
-from transformers import GenerationConfig, set_seed
-
-
-from ..models.utils import ModelWrapper
-from ..models import v2408
+from typing import TYPE_CHECKING
+import json
+
+from ..models.metadata import get_generation_options
+from ..models.metrics import collect_metrics
+from ..models import v2408_metadata as v2408
+from .executor import run_generation
+from .stream import create_streamer
 from .type import (
     DANBOT_MODEL_TYPE,
     DANBOT_GENERATION_CONFIG_TYPE,
+    DANBOT_BAN_MASK_TYPE,
     DANBOT_CATEGORY,
     TEMPLATE_CONFIG_DTYPE,
 )
 
+# torch and transformers are imported on the first execution
+if TYPE_CHECKING:
+    from transformers import GenerationConfig
+
+    from ..models.ban_mask import BanMask
+    from ..models.utils import ModelWrapper
+
 
 INPUT_TYPES = {
     "required": {
@@ -40,6 +51,12 @@ INPUT_TYPES = {
                 "tooltip": "Tags to ban during generation",
             },
         ),
+        "ban_mask": (
+            DANBOT_BAN_MASK_TYPE,
+            {
+                "tooltip": "Compiled ban mask. Combined with ban_tags if both are given.",
+            },
+        ),
         "translation_template_config": (TEMPLATE_CONFIG_DTYPE,),
         "extension_template_config": (TEMPLATE_CONFIG_DTYPE,),
         "generation_config": (
@@ -49,6 +66,9 @@ INPUT_TYPES = {
             },
         ),
     },
+    "hidden": {
+        "unique_id": "UNIQUE_ID",  # used to stream the generated tags
+    },
 }
 
 
@@ -65,16 +85,21 @@ class V2408PipelineNode:
         "STRING",
         "STRING",
         "STRING",
+        "STRING",
     )
     RETURN_NAMES = (
         "generated_tags",
         "translated_tags",
         "extended_tags",
         "raw_output",
+        "metrics",
     )
     OUTPUT_TOOLIPS = (
         "The generated tags.",
+        "The translated tags.",
+        "The extended tags.",
         "The raw output of the model. This includes the special tokens.",
+        "Timing and token counts of both stages in JSON.",
     )
 
     FUNCTION = "generate"
@@ -83,12 +108,13 @@ class V2408PipelineNode:
 
     CATEGORY = DANBOT_CATEGORY
 
-    def generate(
+    async def generate(
         self,
-        danbot_model: ModelWrapper,
+        danbot_model: "ModelWrapper",
         text_prompt: str,
         seed: int,
         ban_tags: str | None = None,
+        ban_mask: "BanMask | None" = None,
         translation_template_config: v2408.TemplateConfig = v2408.TemplateConfig(
             aspect_ratio="tall",
             rating="general",
@@ -99,90 +125,115 @@ class V2408PipelineNode:
             rating="general",
             length="long",
         ),
-        generation_config: GenerationConfig = GenerationConfig(
-            do_sample=False,
-            max_new_tokens=256,
-        ),
+        generation_config: "GenerationConfig | None" = None,
+        unique_id: str | None = None,
     ):
-        set_seed(seed)
-        # 1. translate
-        translation_template = danbot_model.format_prompt(
-            template_name="translation",
-            format_kwargs={
-                "aspect_ratio": v2408.ASPECT_RATIO_MAP[
-                    translation_template_config.aspect_ratio
-                ],
-                "rating": v2408.RATING_MAP[translation_template_config.rating],
-                "length": v2408.LENGTH_MAP[translation_template_config.length],
-            },
-        )
-        _full, _new, raw = danbot_model.generate(
-            text_prompt=text_prompt,
-            tag_template=translation_template,
-            generation_config=GenerationConfig(
+        from transformers import GenerationConfig
+
+        if generation_config is None:
+            generation_config = GenerationConfig(do_sample=False, max_new_tokens=256)
+
+        with collect_metrics() as metrics:
+            # the encoder output is shared by both stages,
+            # and computed only when a stage is not cached
+            encoded_prompt = danbot_model.encode(text_prompt)
+
+            # 1. translate
+            translation_template = danbot_model.format_prompt(
+                template_name="translation",
+                format_kwargs={
+                    "aspect_ratio": v2408.ASPECT_RATIO_MAP[
+                        translation_template_config.aspect_ratio
+                    ],
+                    "rating": v2408.RATING_MAP[translation_template_config.rating],
+                    "length": v2408.LENGTH_MAP[translation_template_config.length],
+                },
+            )
+            translation_config = GenerationConfig(
                 do_sample=False,
                 max_new_tokens=generation_config.max_new_tokens,
-            ),
-            ban_tags=ban_tags,
-            stop_token=v2408.TRANSLATION_END,
-        )
-        translation = danbot_model.extract_translation_result(raw)
-
-        # 2. extend
-        copyright_tags = translation.get("copyright", "")
-        character_tags = translation.get("character", "")
-        translation_tags = translation.get("translation", "")
-
-        extension_template = danbot_model.format_prompt(
-            template_name="extension",
-            format_kwargs={
-                "aspect_ratio": v2408.ASPECT_RATIO_MAP[
-                    extension_template_config.aspect_ratio
-                ],
-                "rating": v2408.RATING_MAP[extension_template_config.rating],
-                "length": v2408.LENGTH_MAP[extension_template_config.length],
-                "copyright": copyright_tags,
-                "character": character_tags,
-                "translation": translation_tags,
-            },
-        )
-        _full, _new, raw = danbot_model.generate(
-            text_prompt=text_prompt,
-            tag_template=extension_template,
-            generation_config=generation_config,
-            ban_tags=ban_tags,
-            stop_token=v2408.EXTENSION_END,
-        )
-        extension = danbot_model.extract_extension_result(raw)
-
-        extension_tags = extension.get("extension", "")
-        output_tags = ", ".join(
-            [
-                part
-                for part in (
-                    copyright_tags,
-                    character_tags,
-                    translation_tags,
-                    extension_tags,
-                )
-                if part.strip()
-            ]
-        )
-        translated_tags = ", ".join(
-            [
-                part
-                for part in (
-                    copyright_tags,
-                    character_tags,
-                    translation_tags,
-                )
-                if part.strip()
-            ]
-        )
+                **get_generation_options(generation_config),
+            )
+            _full, _new, raw = await run_generation(
+                danbot_model,
+                text_prompt=text_prompt,
+                tag_template=translation_template,
+                generation_config=translation_config,
+                seed=seed,
+                encoded_prompt=encoded_prompt,
+                ban_tags=ban_tags,
+                ban_mask=ban_mask,
+                stop_token=v2408.TRANSLATION_STOP_TOKENS,
+                streamer=create_streamer(
+                    danbot_model, translation_config, unique_id
+                ),
+            )
+            translation = danbot_model.extract_translation_result(raw)
+
+            # 2. extend
+            copyright_tags = translation.get("copyright", "")
+            character_tags = translation.get("character", "")
+            translation_tags = translation.get("translation", "")
+            translated_tags = ", ".join(
+                [
+                    part
+                    for part in (
+                        copyright_tags,
+                        character_tags,
+                        translation_tags,
+                    )
+                    if part.strip()
+                ]
+            )
+
+            extension_template = danbot_model.format_prompt(
+                template_name="extension",
+                format_kwargs={
+                    "aspect_ratio": v2408.ASPECT_RATIO_MAP[
+                        extension_template_config.aspect_ratio
+                    ],
+                    "rating": v2408.RATING_MAP[extension_template_config.rating],
+                    "length": v2408.LENGTH_MAP[extension_template_config.length],
+                    "copyright": copyright_tags,
+                    "character": character_tags,
+                    "translation": translation_tags,
+                },
+            )
+            _full, _new, raw = await run_generation(
+                danbot_model,
+                text_prompt=text_prompt,
+                tag_template=extension_template,
+                generation_config=generation_config,
+                seed=None,  # continue from the translation stage
+                encoded_prompt=encoded_prompt,
+                ban_tags=ban_tags,
+                ban_mask=ban_mask,
+                stop_token=v2408.EXTENSION_STOP_TOKENS,
+                # continue streaming after the translated tags
+                streamer=create_streamer(
+                    danbot_model, generation_config, unique_id, prefix=translated_tags
+                ),
+            )
+            extension = danbot_model.extract_extension_result(raw)
+
+            extension_tags = extension.get("extension", "")
+            output_tags = ", ".join(
+                [
+                    part
+                    for part in (
+                        copyright_tags,
+                        character_tags,
+                        translation_tags,
+                        extension_tags,
+                    )
+                    if part.strip()
+                ]
+            )
 
         return (
             output_tags,
             translated_tags,
             extension_tags,
             raw,
+            json.dumps(metrics.to_dict()),
         )
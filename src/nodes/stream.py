@@ -0,0 +1,39 @@
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from transformers import GenerationConfig
+
+    from ..models.utils import ModelWrapper
+    from ..models.streamer import TagStreamer
+
+STREAM_EVENT = "danbot.stream"
+
+
+def create_streamer(
+    model: "ModelWrapper",
+    generation_config: "GenerationConfig",
+    unique_id: str | None,
+    prefix: str = "",
+) -> "TagStreamer | None":
+    """
+    Create a streamer that sends the generated tags to the frontend node `unique_id`.
+    Returns None for beam search, which transformers can not stream.
+    """
+    if unique_id is None or generation_config.num_beams > 1:
+        return None
+
+    from server import PromptServer
+
+    from ..models.streamer import TagStreamer
+
+    def send(text: str, done: bool):
+        PromptServer.instance.send_sync(
+            STREAM_EVENT,
+            {
+                "node": unique_id,
+                "text": text,
+                "done": done,
+            },
+        )
+
+    return TagStreamer(model, send, prefix=prefix)
@@ -2,6 +2,7 @@
 
 DANBOT_MODEL_TYPE = "DANBOT_MODEL"
 DANBOT_GENERATION_CONFIG_TYPE = "DANBOT_GENERATION_CONFIG"
+DANBOT_BAN_MASK_TYPE = "DANBOT_BAN_MASK"
 DANBOT_CATEGORY = "prompt/Danbooru Tags Translator"
 
 FORMAT_KWARGS_DTYPE = "DANBOT_FORMAT_KWARGS"
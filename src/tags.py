@@ -12,6 +12,7 @@ GENERAL_TAGS = ["safe", "general"]
 
 SELF_PATH_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
 TAGS_ROOT_DIR = SELF_PATH_DIR / ".." / "tags"
+BAN_TEMPLATE_DIR = TAGS_ROOT_DIR / "ban_template"
 
 
 def estimate_rating(tags: list[str]) -> RATING_TYPE:
@@ -27,7 +28,11 @@ def estimate_rating(tags: list[str]) -> RATING_TYPE:
 
 def load_tags(path: str | Path) -> list[str]:
     with open(path, "r") as f:
-        tags = f.read().splitlines()
+        return parse_tags(f.read())
+
+
+def parse_tags(text: str) -> list[str]:
+    tags = text.splitlines()
 
     # remove comment out with "//"
     tags = [tag.split("//")[0] for tag in tags if not tag.startswith("//")]
@@ -0,0 +1,58 @@
+import torch
+
+from src.models.stopping_criteria import StopSequencesCriteria, normalize_stop_tokens
+
+STOP_SEQUENCES = {"</general>": [9], "</a>": [7, 8]}
+PROMPT_LENGTH = 2
+
+
+def test_normalize_stop_tokens():
+    assert normalize_stop_tokens("</a>", 2) == [["</a>"], ["</a>"]]
+    assert normalize_stop_tokens(["</a>", "</b>"], 1) == [["</a>", "</b>"]]
+    assert normalize_stop_tokens([["</a>"], []], 2) == [["</a>"], []]
+
+
+def test_greedy_rows_stop_at_their_own_stop_strings():
+    criteria = StopSequencesCriteria(
+        STOP_SEQUENCES,
+        row_stop_strings=[["</general>"], ["</a>"], []],
+        prompt_length=PROMPT_LENGTH,
+    )
+    scores = torch.zeros(3, 10)
+
+    input_ids = torch.tensor([[0, 0, 9], [0, 0, 9], [0, 0, 9]])
+    assert criteria(input_ids, scores).tolist() == [True, False, False]
+
+    input_ids = torch.tensor([[0, 0, 9, 1, 8], [0, 0, 9, 7, 8], [0, 0, 9, 7, 8]])
+    # the first row stays stopped
+    assert criteria(input_ids, scores).tolist() == [True, True, False]
+    assert criteria.fired_stop_strings() == ["</general>", "</a>", None]
+
+
+def test_stop_sequences_must_be_generated():
+    criteria = StopSequencesCriteria(
+        STOP_SEQUENCES,
+        row_stop_strings=[["</a>"]],
+        prompt_length=PROMPT_LENGTH,
+    )
+    # "</a>" starts in the prompt
+    input_ids = torch.tensor([[0, 7, 8]])
+    assert criteria(input_ids, torch.zeros(1, 10)).tolist() == [False]
+
+
+def test_beam_rows_share_the_stop_strings_of_their_prompt():
+    num_beams = 2
+    criteria = StopSequencesCriteria(
+        STOP_SEQUENCES,
+        row_stop_strings=[["</general>"], ["</a>"]],
+        prompt_length=PROMPT_LENGTH,
+        num_beams=num_beams,
+    )
+    scores = torch.zeros(2 * num_beams, 10)
+
+    input_ids = torch.tensor([[0, 0, 9], [0, 0, 1], [0, 0, 9], [0, 0, 8]])
+    assert criteria(input_ids, scores).tolist() == [True, False, False, False]
+
+    # the beams are reordered, so a row is not stopped by the earlier steps
+    input_ids = torch.tensor([[0, 0, 1, 2], [0, 0, 9, 9], [0, 0, 7, 8], [0, 0, 7, 8]])
+    assert criteria(input_ids, scores).tolist() == [False, True, True, True]